@@ -0,0 +1,93 @@
+#include <riscv_decompressor_test.h>
+#include <fstream>
+#include <iomanip>
+
+/* Table-driven decompression test over packed binary test vectors produced by
+ * `gen_decompressor.py --testVectorsOut`. Registered only if the file existed when the project was
+ * configured.
+ */
+#ifdef DECOMPRESSOR_TEST_VECTORS_PATH
+
+namespace {
+
+class DecompressionTestVectors {
+public:
+    struct Record {
+        uint32_t insn32;
+        uint16_t insn16;
+        uint16_t cmdIdx;
+    };
+
+    std::vector<std::string> names;
+    std::vector<Record> records;
+
+    DecompressionTestVectors(const char *path)
+    {
+        std::ifstream f(path, std::ios::binary | std::ios::ate);
+        if (!f) {
+            throw std::runtime_error(std::string("Failed to open test vectors file: ") + path);
+        }
+        std::vector<uint8_t> data(f.tellg());
+        f.seekg(0);
+        if (!f.read(reinterpret_cast<char *>(data.data()), data.size())) {
+            throw std::runtime_error(std::string("Failed to read test vectors file: ") + path);
+        }
+
+        if (data.size() < HEADER_SIZE || std::string(data.begin(), data.begin() + 4) != "RVCV" ||
+            Get32(data, 4) != VERSION) {
+            throw std::runtime_error("Bad test vectors file header");
+        }
+        size_t numNames = Get32(data, 8), namesSize = Get32(data, 12);
+        if (HEADER_SIZE + namesSize > data.size() ||
+            (data.size() - HEADER_SIZE - namesSize) % RECORD_SIZE != 0) {
+            throw std::runtime_error("Bad test vectors file size");
+        }
+        const char *namePtr = reinterpret_cast<const char *>(data.data() + HEADER_SIZE);
+        for (size_t i = 0; i < numNames; i++) {
+            names.emplace_back(namePtr);
+            namePtr += names.back().size() + 1;
+        }
+        for (size_t offset = HEADER_SIZE + namesSize; offset < data.size(); offset += RECORD_SIZE) {
+            Record r{Get32(data, offset), Get16(data, offset + 4), Get16(data, offset + 6)};
+            if (r.cmdIdx >= names.size()) {
+                throw std::runtime_error("Bad command index in test vectors file");
+            }
+            records.push_back(r);
+        }
+    }
+
+private:
+    static constexpr uint32_t VERSION = 1;
+    static constexpr size_t HEADER_SIZE = 16, RECORD_SIZE = 8;
+
+    static uint16_t
+    Get16(const std::vector<uint8_t> &data, size_t offset)
+    {
+        return data[offset] | (data[offset + 1] << 8);
+    }
+
+    static uint32_t
+    Get32(const std::vector<uint8_t> &data, size_t offset)
+    {
+        return Get16(data, offset) | (static_cast<uint32_t>(Get16(data, offset + 2)) << 16);
+    }
+};
+
+} /* anonymous namespace */
+
+
+REGISTER_TEST_FUNC("Instruction decompression: test vectors", ([](TestInstance &test){
+    DecompressionTestVectors vectors(DECOMPRESSOR_TEST_VECTORS_PATH);
+    for (const auto &r: vectors.records) {
+        uint32_t insnCode = FetchCompressedInsn(test, r.insn16);
+        if (insnCode != r.insn32) {
+            std::stringstream ss;
+            ss << std::hex << std::setfill('0') << vectors.names[r.cmdIdx] << " 0x" <<
+                std::setw(4) << r.insn16 << ": decompressed 0x" << std::setw(8) << insnCode <<
+                ", expected 0x" << std::setw(8) << r.insn32;
+            FAIL(ss.str());
+        }
+    }
+}));
+
+#endif /* DECOMPRESSOR_TEST_VECTORS_PATH */
@@ -0,0 +1,54 @@
+#ifndef INCLUDE_RISCV_DECOMPRESSOR_TEST_H
+#define INCLUDE_RISCV_DECOMPRESSOR_TEST_H
+
+#include <test_runner.h>
+
+
+/** Run the core until the compressed instruction placed at program start is fetched.
+ * @return Decompressed instruction code.
+ */
+inline uint32_t
+FetchCompressedInsn(TestInstance &test, uint16_t insn16)
+{
+    test.progMem[0] = insn16 & 0xff;
+    test.progMem[1] = insn16 >> 8;
+    test.Reset();
+    ASSERT_EQUAL(test.module->dbgState, RiscvCore::State::INSN_FETCH);
+    while (test.module->dbgState != RiscvCore::State::INSN_FETCHED) {
+        test.Clock();
+    }
+    return test.module->dbgInsnCode;
+}
+
+
+class DecompressionTestCase: public TestCase {
+public:
+    DecompressionTestCase(TestInstance &test,
+                          const std::vector<uint8_t> &insn16, const std::vector<uint8_t> &insn32):
+        TestCase(test),
+        insn16(insn16),
+        insn32(insn32)
+    {}
+
+    void
+    Run() override
+    {
+        uint32_t insnCode = FetchCompressedInsn(test, (insn16[0] << 8) | insn16[1]);
+        uint32_t opcode = (insn32[0] << 24) | (insn32[1] << 16) | (insn32[2] << 8) | insn32[3];
+        ASSERT_EQUAL(insnCode, opcode);
+    }
+
+private:
+    std::vector<uint8_t> insn16, insn32;
+};
+
+
+#define MAKE_VECTOR(...) std::vector<uint8_t>{__VA_ARGS__}
+
+#define TEST_CASE(__name, __insn16, __insn32) \
+    REGISTER_TEST("Instruction decompression: " __name, [](TestInstance &test){ \
+        return std::make_shared<DecompressionTestCase>(test, \
+            MAKE_VECTOR __insn16, MAKE_VECTOR __insn32); \
+    });
+
+#endif /* INCLUDE_RISCV_DECOMPRESSOR_TEST_H */
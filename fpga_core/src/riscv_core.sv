@@ -45,13 +45,24 @@ endinterface
 // Decompresses 16 bits instruction code into full 32 bits code (assume two LSB ix 2'b11)
 module RiscvInsnDecompressor(input wire [15:0] insn16, output reg [31:2] insn32);
 
-always_comb begin
 // Implementation is in a generated file
 `include "generated/riscv_insn_decompressor_impl.sv"
-end
 
 endmodule
 
+`ifdef DECOMPRESSOR_REGISTERED
+// Registered decompressor variant with one clock latency: the output corresponds to the input
+// sampled on the previous clock edge with enable set. Command selection and fields reassembly are
+// split by the register stage, so the critical path is shorter.
+module RiscvInsnDecompressorRegistered(input wire clock, input wire enable,
+                                       input wire [15:0] insn16, output reg [31:2] insn32);
+
+// Implementation is in a generated file
+`include "generated/riscv_insn_decompressor_registered_impl.sv"
+
+endmodule
+`endif
+
 typedef enum [3:0] {
     // Values are direct bits mappings from an opcode.
     OP_ADD = 4'b0000,
@@ -212,7 +223,14 @@ module RiscvCore
     // Indicates 32 bits opcode.
     reg isInsn32;
     wire [31:2] decompressedInsn;
-    RiscvInsnDecompressor insnDcmp(.insn16(insnBuf[31:16]), .insn32(decompressedInsn));
+    `ifdef DECOMPRESSOR_REGISTERED
+        RiscvInsnDecompressorRegistered insnDcmp(.clock(cpuSignals.clock), .enable(1'b1),
+                                                 .insn16(insnBuf[31:16]), .insn32(decompressedInsn));
+        // Compressed instruction is fetched, waiting one clock for the decompressor output.
+        reg insnDcmpWait;
+    `else
+        RiscvInsnDecompressor insnDcmp(.insn16(insnBuf[31:16]), .insn32(decompressedInsn));
+    `endif
     // Full 32 bits instruction view. Either decompressed or initial full size instruction.
     wire [31:2] insn32 = isInsn32 ? insnBuf[31:2] : decompressedInsn;
     `ifdef DEBUG
@@ -288,6 +306,9 @@ module RiscvCore
             memWriteEnable <= 0;
             state <= S_INSN_FETCH;
             isInsn32 <= 0;
+            `ifdef DECOMPRESSOR_REGISTERED
+                insnDcmpWait <= 0;
+            `endif
             shiftCounter <= 0;
             shiftStart <= 0;
             shiftEnable <= 0;
@@ -339,6 +360,12 @@ module RiscvCore
             case (state)
 
             S_INSN_FETCH: begin
+                `ifdef DECOMPRESSOR_REGISTERED
+                if (insnDcmpWait) begin
+                    insnDcmpWait <= 0;
+                    state <= S_INSN_FETCHED;
+                end else
+                `endif
                 if (memoryBus.ready) begin
                     pc <= nextPc;
                     memStrobe <= 0;
@@ -349,8 +376,14 @@ module RiscvCore
 
                     if (pc[0]) begin
                         // 16 or 32 bits have been read.
-                        if (isInsn32 || !`IS_INSN32(insnBuf[31:24])) begin
+                        if (isInsn32) begin
                             state <= S_INSN_FETCHED;
+                        end else if (!`IS_INSN32(insnBuf[31:24])) begin
+                            `ifdef DECOMPRESSOR_REGISTERED
+                                insnDcmpWait <= 1;
+                            `else
+                                state <= S_INSN_FETCHED;
+                            `endif
                         end else  begin
                             isInsn32 <= 1;
                         end
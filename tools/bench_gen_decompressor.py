@@ -0,0 +1,176 @@
+"""Benchmark for gen_decompressor.py phases. Each phase is timed over the real commands tables and
+over scaled-up synthetic tables, so that superlinear growth is visible when commands are added.
+Results are written as JSON, and can be compared against a stored baseline.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import gen_decompressor as g
+
+
+# Synthetic commands share positions of constant bits, so that any two of them are disjoint when
+# constant values differ. Constant bits: [15:11], [7:5], [1:0]. Two LSB take three values only,
+# since 2'b11 indicates full size command, other 8 bits take any value.
+SYNTHETIC_MAX_COMMANDS = 3 * (1 << 8)
+
+
+def DefineSyntheticCommands16(numCommands, seed=0):
+    """Define synthetic compressed commands with random distinct encodings. Half of them have two
+    compressed register fields and map to register-register operations, half have compressed
+    register and signed immediate fields and map to ANDI.
+    """
+    if numCommands > SYNTHETIC_MAX_COMMANDS:
+        raise Exception(f"Too many synthetic commands: {numCommands}")
+    rng = random.Random(seed)
+    codes = rng.sample(range(SYNTHETIC_MAX_COMMANDS), numCommands)
+    for idx, code in enumerate(codes):
+        # Two LSB are not allowed to be 2'b11 which indicates full size command
+        lo = format(code % 3, "02b")
+        hi = format(code // 3 >> 3, "05b")
+        mid = format(code // 3 & 7, "03b")
+        if idx % 2 == 0:
+            g.cmd16(f"C.SYN{idx}", g.mapTo(rng.choice(("ADD", "SUB", "XOR", "OR", "AND"))),
+                    g.b(hi), g.rsdp(), g.b(mid), g.rs2p(), g.b(lo))
+        else:
+            g.cmd16(f"C.SYN{idx}", g.mapTo("ANDI"),
+                    g.b(hi), g.rsdp(), g.b(mid), g.imm(5,3), g.b(lo))
+
+
+def ResetCommands():
+    g.commands32.clear()
+    g.commands16.clear()
+    g.commandTransforms.clear()
+    g.selectionTree = None
+
+
+def Measure(numRepeat, func):
+    """
+    :return: Tuple (minimal elapsed time in seconds among repetitions, last result).
+    """
+    bestTime = None
+    for _ in range(numRepeat):
+        startTime = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - startTime
+        if bestTime is None or elapsed < bestTime:
+            bestTime = elapsed
+    return bestTime, result
+
+
+def RunPhases(defineCommands16, withSelfTest, numRepeat, tmpDir):
+    """Run all phases for one commands table.
+    :param defineCommands16: Function to define compressed commands.
+    :param withSelfTest: Run self-test phase (possible for the real table only).
+    :return: Dictionary with the table results.
+    """
+    phases = {}
+
+    def DefineCommands():
+        ResetCommands()
+        g.DefineCommands32()
+        defineCommands16()
+    phases["DefineCommands"], _ = Measure(numRepeat, DefineCommands)
+    commands = list(g.commands16.values())
+
+    phases["SelectionTree.Generate"], selTree = Measure(
+        numRepeat, lambda: g.SelectionTree.Generate(commands))
+    phases["CommandTransform"], _ = Measure(
+        numRepeat, lambda: [g.CommandTransform(cmd) for cmd in commands])
+    phases["GenerateVerilog"], _ = Measure(
+        numRepeat, lambda: selTree.GenerateVerilog("insn16", "insn32"))
+    phases["GenerateTestCpp"], _ = Measure(
+        numRepeat, lambda: g.GenerateTestCpp(os.path.join(tmpDir, "test_data.inc")))
+    if withSelfTest:
+        # Built-in encoder, so that toolchain speed does not affect results
+        with contextlib.redirect_stdout(io.StringIO()):
+            phases["DoSelfTest"], _ = Measure(numRepeat, g.DoSelfTest)
+
+    return {"numCommands": len(commands), "phases": phases}
+
+
+def CompareWithBaseline(results, baseline, maxRatio, minDelta):
+    """Print comparison with the baseline.
+    :return: Number of regressed phases.
+    """
+    numRegressed = 0
+    print(f"{'Table':<16} {'Phase':<24} {'Baseline, ms':>12} {'Current, ms':>12} {'Ratio':>7}")
+    for tableName, table in results["tables"].items():
+        baseTable = baseline["tables"].get(tableName)
+        if baseTable is None:
+            continue
+        for phase, curTime in table["phases"].items():
+            baseTime = baseTable["phases"].get(phase)
+            if baseTime is None:
+                continue
+            ratio = curTime / baseTime if baseTime > 0 else float("inf")
+            isRegressed = curTime > baseTime * maxRatio and curTime - baseTime > minDelta
+            if isRegressed:
+                numRegressed += 1
+            print(f"{tableName:<16} {phase:<24} {baseTime * 1000:>12.2f} {curTime * 1000:>12.2f} " +
+                  f"{ratio:>7.2f}{'  REGRESSED' if isRegressed else ''}")
+    return numRegressed
+
+
+def Main():
+    parser = argparse.ArgumentParser(description="Benchmark gen_decompressor.py phases")
+    parser.add_argument("--scales", metavar="LIST", type=str, default="1,4,16",
+                        help="Comma-separated synthetic table sizes as multiples of the real " +
+                        "compressed commands number")
+    parser.add_argument("--repeat", metavar="N", type=int, default=3,
+                        help="Number of repetitions for each phase, minimal time is reported")
+    parser.add_argument("--out", metavar="OUTPUT_PATH", type=str,
+                        help="Path for JSON results output")
+    parser.add_argument("--baseline", metavar="BASELINE_PATH", type=str,
+                        help="JSON results of a previous run to compare with")
+    parser.add_argument("--maxRatio", metavar="RATIO", type=float, default=1.5,
+                        help="Phase is regressed if it is slower than baseline by this ratio")
+    parser.add_argument("--minDelta", metavar="SECONDS", type=float, default=0.005,
+                        help="Phase is not considered regressed if it is slower than baseline by " +
+                        "less than this time, to ignore noise for very short phases")
+    benchArgs = parser.parse_args()
+
+    g.args = g.CreateArgParser().parse_args(["--asmOracle", "builtin", "--jobs", "1"])
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "tables": {}
+    }
+    with tempfile.TemporaryDirectory() as tmpDir:
+        results["tables"]["real"] = RunPhases(g.DefineCommands16, True, benchArgs.repeat, tmpDir)
+        numReal = results["tables"]["real"]["numCommands"]
+        for scale in map(int, benchArgs.scales.split(",")):
+            numCommands = min(numReal * scale, SYNTHETIC_MAX_COMMANDS)
+            results["tables"][f"synthetic_x{scale}"] = RunPhases(
+                lambda: DefineSyntheticCommands16(numCommands), False, benchArgs.repeat, tmpDir)
+
+    for tableName, table in results["tables"].items():
+        print(f"\n{tableName}: {table['numCommands']} commands")
+        for phase, elapsed in table["phases"].items():
+            print(f"    {phase:<24} {elapsed * 1000:10.2f} ms")
+    print()
+
+    if benchArgs.out:
+        with open(benchArgs.out, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if benchArgs.baseline:
+        with open(benchArgs.baseline, "r") as f:
+            baseline = json.load(f)
+        numRegressed = CompareWithBaseline(results, baseline, benchArgs.maxRatio,
+                                           benchArgs.minDelta)
+        if numRegressed > 0:
+            print(f"\n{numRegressed} phases regressed by more than {benchArgs.maxRatio}x")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    Main()
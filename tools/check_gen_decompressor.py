@@ -0,0 +1,131 @@
+"""Regression run for gen_decompressor.py with degenerate commands tables. Usage profile pruning may
+leave a single compressed command or none at all (an image without RVC usage), all outputs must
+still be generated and verified for every decompressor style. Random test data is also checked to
+never contain reserved encodings.
+"""
+import os
+import struct
+import sys
+import tempfile
+
+import gen_decompressor as g
+
+
+# Raw program images: name, content, expected number of compressed commands left after pruning
+IMAGES = (
+    # Full size instructions only: `addi x1, x1, 1`
+    ("no_rvc", struct.pack("<I", 0x00108093) * 4, 0),
+    # `c.mv x10, x11` only
+    ("single_cmd", struct.pack("<HH", 0x852e, 0x852e), 1)
+)
+
+STYLES = ("tree", "casez", "sop")
+
+# Number of random test cases per command for reserved encodings check
+NUM_RANDOM_TESTS = 2000
+
+
+def IsReservedEncoding(opcode):
+    """Check the compressed opcode against reserved encodings of RV32C, independently of the
+    generator commands definitions.
+    """
+    funct3 = opcode >> 13
+    quadrant = opcode & 0b11
+    rd = (opcode >> 7) & 0x1f
+    rs2 = (opcode >> 2) & 0x1f
+    # C.ADDI4SPN with zero immediate
+    if quadrant == 0b00 and funct3 == 0b000:
+        return (opcode >> 5) & 0xff == 0
+    # C.ADDI16SP and C.LUI with zero immediate
+    if quadrant == 0b01 and funct3 == 0b011:
+        return (opcode >> 12) & 1 == 0 and rs2 == 0
+    # C.LWSP with x0 destination
+    if quadrant == 0b10 and funct3 == 0b010:
+        return rd == 0
+    # C.JR with x0 source, C.EBREAK
+    if quadrant == 0b10 and funct3 == 0b100:
+        return rd == 0 and rs2 == 0
+    return False
+
+
+def CheckRandomCases():
+    """Verify that random test data never contains reserved encodings."""
+    ResetCommands()
+    g.args = g.CreateArgParser().parse_args(["--randomTests", str(NUM_RANDOM_TESTS)])
+    g.DefineCommands32()
+    g.DefineCommands16()
+    numCases = 0
+    for _, cmd, tc, _, _ in g.GenerateTestData():
+        opc16 = cmd.GenerateOpcodeInt(tc)
+        if IsReservedEncoding(opc16):
+            raise Exception(f"Reserved encoding 0x{opc16:04x} generated for {cmd}: {tc}")
+        numCases += 1
+    print(f"{numCases} test cases have no reserved encodings")
+
+
+def ResetCommands():
+    g.commands32.clear()
+    g.commands16.clear()
+    g.commandTransforms.clear()
+    g.selectionTree = None
+
+
+def RunCase(tmpDir, imagePath, style):
+    """Run generation with all the outputs for the image usage profile.
+    :return: Number of compressed commands left after pruning.
+    """
+    def Out(name):
+        return os.path.join(tmpDir, f"{style}_{name}")
+
+    argv = ["--usageProfile", imagePath, "--decompStyle", style,
+            "--doSelfTest", "--asmOracle", "builtin", "--jobs", "1", "--randomTests", "4",
+            "--exhaustiveCheck", "--costReport",
+            "--decompOut", Out("decompressor.sv"),
+            "--decompTestbenchOut", Out("decompressor_test.sv"),
+            "--testCppOut", Out("test_data.inc"),
+            "--testVectorsOut", Out("test_vectors.bin"),
+            "--decompTableOut", Out("table.bin"),
+            "--usageCheckOut", Out("rvc_usage_check.cmake"),
+            "--decompressImage", imagePath, "--imageOut", Out("image.bin")]
+    if style != "sop":
+        argv += ["--decompShare", "--decompRegisteredOut", Out("decompressor_registered.sv")]
+    ResetCommands()
+    g.args = g.CreateArgParser().parse_args(argv)
+    g.Generate()
+    # The image itself must pass the usage check against the pruned table
+    g.CheckImages([imagePath], list(g.commands16.keys()))
+    return len(g.commands16)
+
+
+def Main():
+    numFailed = 0
+    with tempfile.TemporaryDirectory() as tmpDir:
+        for name, content, expectedCommands in IMAGES:
+            imagePath = os.path.join(tmpDir, f"{name}.bin")
+            with open(imagePath, "wb") as f:
+                f.write(content)
+            for style in STYLES:
+                print(f"\n=== {name}, {style}")
+                try:
+                    numCommands = RunCase(tmpDir, imagePath, style)
+                    if numCommands != expectedCommands:
+                        raise Exception(f"{numCommands} commands left after pruning, " +
+                                        f"{expectedCommands} expected")
+                except Exception as e:
+                    print(f"FAILED: {name}, {style}: {e}")
+                    numFailed += 1
+    print("\n=== random test data")
+    try:
+        CheckRandomCases()
+    except Exception as e:
+        print(f"FAILED: random test data: {e}")
+        numFailed += 1
+    print()
+    if numFailed > 0:
+        print(f"{numFailed} cases failed")
+        sys.exit(1)
+    print("All cases passed")
+
+
+if __name__ == "__main__":
+    Main()
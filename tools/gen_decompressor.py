@@ -1,10 +1,38 @@
 import argparse
+from array import array
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import cProfile
 from enum import Enum, auto
+import hashlib
+import io
+import itertools
+import json
+import mmap
 import os
+import random
 import re
+import shutil
+import stat
+import struct
 import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    # Optional, required only for NumPy exports and vectorized verification
+    np = None
 
 args = None
+# AsmCache instance if assembled opcodes caching is enabled
+asmCache = None
+# Profiler instance if profiling is enabled
+profiler = None
 
 class OpcodeComponent:
     """Bit-field in a command opcode.
@@ -44,32 +72,18 @@ class Bindings:
         :return Binding value, None if not found.
         """
         if isinstance(ref, ImmediateBits):
-            predicate = lambda ref: isinstance(ref, ImmediateBits)
+            value = next((b[1] for b in self.items if isinstance(b[0], ImmediateBits)), None)
         elif isinstance(ref, RegReference):
-            if ref.regType == RegType.SRC1:
-                regList = [RegType.SRC1, RegType.SRC_DST]
-            elif ref.regType == RegType.DST:
-                regList = [RegType.DST, RegType.SRC_DST]
-            else:
-                regList = [ref.regType]
-            predicate = lambda c: isinstance(c, RegReference) and (c.regType in regList)
+            regTypes = GetMatchingRegTypes(ref.regType)
+            value = next((b[1] for b in self.items
+                          if isinstance(b[0], RegReference) and b[0].regType in regTypes), None)
         else:
             raise Exception("Unsupported reference type")
-        value = next((b[1] for b in self.items if predicate(b[0])), None)
         if isinstance(ref, RegReference) and ref.isNotEqual is not None and value == ref.isNotEqual:
             raise Exception("Constrained register matched to disallowed binding")
         return value
 
 
-def BitStringToBytes(s):
-    l = []
-    idx = 0
-    while idx < len(s):
-        l.append(int(s[idx:idx+8], base=2))
-        idx += 8
-    return bytes(l)
-
-
 class CommandDesc:
     def __init__(self, name, components, mapTo=None, isImmOffset=False) -> None:
         self.name = name
@@ -77,9 +91,13 @@ class CommandDesc:
         self.mapTo = mapTo
         self.isImmOffset = isImmOffset
 
+        self.size = 0
+        for c in components:
+            self.size += c.GetSize()
+
         self.immIsSigned = None
         self.immHiBit = None
-        curPos = self.GetSize() - 1
+        curPos = self.size - 1
         for c in components:
             c.position = curPos
             curPos -= c.GetSize()
@@ -91,6 +109,27 @@ class CommandDesc:
                 if self.immHiBit is None or self.immHiBit < c.hiBit:
                     self.immHiBit = c.hiBit
 
+        # Immediate bit index to the chunk containing it
+        self.immChunks = {}
+        # Opcode bit index to the field containing it
+        self.bitFields = [None] * self.size
+        # Parameter lookup table: "imm" or RegType to the first matching field
+        self.params = {}
+        for c in components:
+            for bitIdx in range(c.position - c.GetSize() + 1, c.position + 1):
+                self.bitFields[bitIdx] = c
+            if isinstance(c, ImmediateBits):
+                for immBit in range(c.loBit, c.hiBit + 1):
+                    self.immChunks.setdefault(immBit, c)
+                self.params.setdefault("imm", c)
+            elif isinstance(c, RegReference):
+                for regType in RegType:
+                    if c.regType in GetMatchingRegTypes(regType):
+                        self.params.setdefault(regType, c)
+        self.constrainedRegisterFields = [c for c in components
+                                          if isinstance(c, RegReference) and
+                                          c.isNotEqual is not None]
+
         # Figure out immediate alignment if any (count missing LSB)
         self.immAlign = 0
         if self.immIsSigned is not None:
@@ -100,6 +139,19 @@ class CommandDesc:
                 else:
                     break
 
+        # Precompiled encoding: all constant bits in one value, and list of tuples (component,
+        # opcode LSB position, field mask) for fields which take bound values.
+        self.constantValue = 0
+        self.constantMask = 0
+        self.encodeFields = []
+        for c in components:
+            loPos = c.position - c.GetSize() + 1
+            if isinstance(c, ConstantBits):
+                self.constantValue |= c.value << loPos
+                self.constantMask |= ((1 << c.size) - 1) << loPos
+            else:
+                self.encodeFields.append((c, loPos, (1 << c.GetSize()) - 1))
+
     def __str__(self) -> str:
         return self.name
 
@@ -116,61 +168,51 @@ class CommandDesc:
                 raise Exception("Constrained register bound to disallowed value")
 
     def GetSize(self):
-        size = 0
-        for comp in self.components:
-            size += comp.GetSize()
-        return size
+        return self.size
 
     def FindParam(self, paramType):
-
         if isinstance(paramType, imm):
-            predicate = lambda c: isinstance(c, imm)
+            return self.params.get("imm")
         elif isinstance(paramType, RegReference):
-
-            if paramType.regType == RegType.SRC1:
-                regList = [RegType.SRC1, RegType.SRC_DST]
-            elif paramType.regType == RegType.DST:
-                regList = [RegType.DST, RegType.SRC_DST]
-            else:
-                regList = [paramType.regType]
-            predicate = lambda c: isinstance(c, RegReference) and (c.regType in regList)
+            return self.params.get(paramType.regType)
         else:
             raise Exception(f"Unsupported parameter type: {paramType}")
 
-        return next((c for c in self.components if predicate(c)), None)
-
     def FindImmediate(self, immBit):
         """
         :param immBit: Immediate bit index to find.
         :return: Immediate chunk reference with the specified bit if found, None if not found.
         """
-        for c in self.components:
-            if not isinstance(c, ImmediateBits):
-                continue
-            if immBit <= c.hiBit and immBit >= c.loBit:
-                return c
-        return None
+        return self.immChunks.get(immBit)
 
     def GetField(self, bitIdx):
         """_summary_
         :return: Field containing the specified bit.
         """
-        for c in self.components:
-            if bitIdx > c.position:
-                raise Exception("Bit index out of range")
-            if bitIdx <= c.position and bitIdx >= c.position - c.GetSize() + 1:
-                return c
-        raise Exception("Failed to find field")
+        if bitIdx >= self.size:
+            raise Exception("Bit index out of range")
+        if bitIdx < 0:
+            raise Exception("Failed to find field")
+        return self.bitFields[bitIdx]
+
+    def Matches(self, opcode):
+        """
+        :param opcode: Opcode as integer.
+        :return: True if the opcode is encoding of this command.
+        """
+        if (opcode & self.constantMask) != self.constantValue:
+            return False
+        for c, loPos, mask in self.encodeFields:
+            if isinstance(c, RegReference) and c.isNotEqual is not None and \
+                ((opcode >> loPos) & mask) == c.isNotEqual:
+                return False
+        return True
 
     def GetConstrainedRegisterFields(self):
         """
         :return: List of register reference fields with not-equal value.
         """
-        l = []
-        for c in self.components:
-            if isinstance(c, RegReference) and c.isNotEqual is not None:
-                l.append(c)
-        return l
+        return self.constrainedRegisterFields
 
     def GenerateTestCases(self):
         """
@@ -201,32 +243,101 @@ class CommandDesc:
             result.append(Generate(False))
         return result
 
-    def GenerateOpcode(self, bindings):
-        """
-        :return: Opcode bytes.
+    def GenerateRandomTestCases(self, count, seed=0):
+        """Generate test cases with random arguments. Values cover the whole encodable range
+        (immediate alignment and signedness, compressed register range, not-equal constraints are
+        respected), boundary values are chosen more often. Reserved arguments listed in
+        RESERVED_ARGUMENTS are never used. Duplicated cases are possible.
+        :param count: Number of test cases to generate.
+        :param seed: Random seed. Each command has its own random stream, so generated cases do not
+        depend on other commands.
+        :return Iterator over bindings for the generated test cases.
         """
-        # First generate bit string, MSB to LSB
-        s = ""
+        rng = random.Random(f"{seed}:{self.name}")
+        reserved = Bindings()
+        reserved.Extend(RESERVED_ARGUMENTS.get(self.name, []))
+
+        immBits = sorted(self.immChunks.keys())
+        def ImmValue(bits):
+            v = 0
+            for bitIdx, isSet in zip(immBits, bits):
+                if isSet:
+                    v |= 1 << bitIdx
+            if self.immIsSigned and (v >> self.immHiBit) & 1:
+                v -= 1 << (self.immHiBit + 1)
+            return v
+
+        # Boundary values: zero, all ones, lowest bit, highest bit, all but highest bit
+        n = len(immBits)
+        immBoundary = [ImmValue([False] * n), ImmValue([True] * n),
+                       ImmValue([i == 0 for i in range(n)]),
+                       ImmValue([i == n - 1 for i in range(n)]),
+                       ImmValue([i != n - 1 for i in range(n)])]
+        reservedImm = reserved.Match(imm())
+        immBoundary = [v for v in immBoundary if v != reservedImm]
+
+        regFields = []
         for c in self.components:
-            if isinstance(c, ConstantBits):
-                s += c.GetBitString()
-            elif isinstance(c, RegReference):
+            if not isinstance(c, RegReference):
+                continue
+            values = list(range(8, 16) if c.isCompressed else range(16))
+            if c.isNotEqual is not None:
+                values.remove(c.isNotEqual)
+            reservedReg = reserved.Match(c)
+            if reservedReg in values:
+                values.remove(reservedReg)
+            regFields.append((c, values))
+
+        for _ in range(count):
+            bindings = Bindings()
+            if self.immIsSigned is not None:
+                if rng.randrange(4) == 0:
+                    v = rng.choice(immBoundary)
+                else:
+                    v = ImmValue([rng.randrange(2) == 1 for _ in range(n)])
+                    while v == reservedImm:
+                        v = ImmValue([rng.randrange(2) == 1 for _ in range(n)])
+                bindings.Append((imm(), v))
+            for c, values in regFields:
+                if rng.randrange(4) == 0:
+                    v = rng.choice((values[0], values[-1]))
+                else:
+                    v = rng.choice(values)
+                bindings.Append((c, v))
+            yield bindings
+
+    def GenerateOpcodeInt(self, bindings):
+        """
+        :return: Opcode as integer.
+        """
+        opcode = self.constantValue
+        for c, loPos, mask in self.encodeFields:
+            if isinstance(c, RegReference):
                 value = bindings.Match(c)
                 if value is None:
                     raise Exception("Failed to match reg ref against provided bindings")
-                s += c.BindValue(value).GetBitString()
+                opcode |= c.EncodeValue(value) << loPos
             elif isinstance(c, ImmediateBits):
                 value = bindings.Match(c)
                 if value is None:
                     raise Exception("Failed to match immediate against provided bindings")
                 if value < 0 and not c.isSigned:
                     raise Exception("Negative value bound for unsigned immediate")
-                s += ConstantBits.FromInt(32, value).Slice(c.hiBit, c.loBit).GetBitString()
+                if value >= (1 << 32) or value < -(1 << 31):
+                    raise Exception(f"Value out of range: {value}")
+                opcode |= ((value >> c.loBit) & mask) << loPos
             else:
                 raise Exception(f"Unrecognized field: {c}")
-        if len(s) != 16 and len(s) != 32:
-            raise Exception(f"Bad opcode length: {len(s)}")
-        return BitStringToBytes(s)
+        return opcode
+
+    def GenerateOpcode(self, bindings):
+        """
+        :return: Opcode bytes.
+        """
+        size = self.GetSize()
+        if size != 16 and size != 32:
+            raise Exception(f"Bad opcode length: {size}")
+        return self.GenerateOpcodeInt(bindings).to_bytes(size // 8, "big")
 
     def GenerateAsm(self, bindings):
         """
@@ -303,16 +414,13 @@ class CommandDesc:
         :param bitIdx: Bit index to test.
         :return: Value of constant bit (1 or 0), or None if the bit is not constant.
         """
-        for c in self.components:
-            csz = c.GetSize()
-            if bitIdx > c.position:
-                raise Exception("Bit index out of range")
-            if bitIdx < c.position - csz + 1:
-                continue
-            if isinstance(c, ConstantBits):
-                return 1 if (c.value & (1 << (c.size - 1 - c.position + bitIdx))) != 0 else 0
+        if bitIdx >= self.size:
+            raise Exception("Bit index out of range")
+        if bitIdx < 0:
+            raise Exception("Unexpected end of list")
+        if (self.constantMask >> bitIdx) & 1 == 0:
             return None
-        raise Exception("Unexpected end of list")
+        return (self.constantValue >> bitIdx) & 1
 
 # Indexed by command name, element is CommandDesc
 commands32 = {}
@@ -336,14 +444,24 @@ class ConstantBits(OpcodeComponent):
             raise Exception("Too long field")
         self.value = int(bits, base=2)
 
+    @staticmethod
+    def _FromUnsigned(size, value):
+        """
+        :param value: Value which is already known to fit into the specified size.
+        """
+        if size > 32:
+            raise Exception("Too long field")
+        bits = ConstantBits.__new__(ConstantBits)
+        bits.size = size
+        bits.value = value
+        return bits
+
     @staticmethod
     def FromInt(size, value):
         max = (1 << size) - 1
-        if value > max or value < -(max + 1) / 2:
+        if value > max or value < -((max + 1) >> 1):
             raise Exception(f"Value out of range: {value}")
-        if value < 0:
-            value = max + 1 + value
-        return ConstantBits(format(value, f"0{size}b"))
+        return ConstantBits._FromUnsigned(size, value & max)
 
     def GetSize(self):
         return self.size
@@ -364,7 +482,8 @@ class ConstantBits(OpcodeComponent):
             raise Exception(f"hiBit out of range: {hiBit}")
         if loBit > hiBit:
             raise Exception(f"loBit is greater than hiBit: {loBit}")
-        return ConstantBits(self.GetBitString()[self.size - 1 - hiBit : self.size - loBit])
+        return ConstantBits._FromUnsigned(hiBit - loBit + 1,
+                                          (self.value >> loBit) & ((1 << (hiBit - loBit + 1)) - 1))
 
 
 b = ConstantBits
@@ -423,6 +542,17 @@ class RegType(Enum):
     DST = auto()
     SRC_DST = auto()
 
+def GetMatchingRegTypes(regType):
+    """
+    :return: Register types which can be matched to the specified one.
+    """
+    if regType == RegType.SRC1:
+        return (RegType.SRC1, RegType.SRC_DST)
+    if regType == RegType.DST:
+        return (RegType.DST, RegType.SRC_DST)
+    return (regType,)
+
+
 class RegReference(OpcodeComponent):
     def __init__(self, regType, isCompressed=False, isNotEqual=None):
         super().__init__()
@@ -433,19 +563,25 @@ class RegReference(OpcodeComponent):
     def GetSize(self):
         return 3 if self.isCompressed else 5
 
-    def BindValue(self, value):
+    def EncodeValue(self, value):
         """
         :param value: value Register index
-        :return ConstantBits for the field with the specified value.
+        :return Field value (integer) for the specified register index.
         """
         if value < 0 or value > 15:
             raise Exception(f"Illegal register index: {value}")
         if self.isCompressed:
             if value < 8:
                 raise Exception(f"Illegal register index for compressed field: {value}")
-            return ConstantBits.FromInt(3, value - 8)
-        else:
-            return ConstantBits.FromInt(5, value)
+            return value - 8
+        return value
+
+    def BindValue(self, value):
+        """
+        :param value: value Register index
+        :return ConstantBits for the field with the specified value.
+        """
+        return ConstantBits._FromUnsigned(self.GetSize(), self.EncodeValue(value))
 
     def __str__(self) -> str:
         s = "r"
@@ -635,6 +771,19 @@ def DefineCommands16():
         b("110"), uimm(5,2), uimm(7,6), rs2(), b("10"),
         isImmOffset=True)
 
+
+# Arguments giving reserved encodings which are not expressed by the commands definitions above (the
+# decoder does not need to reject them). Random test cases never use these values.
+RESERVED_ARGUMENTS = {
+    "C.ADDI4SPN": [(imm(), 0)],
+    "C.ADDI16SP": [(imm(), 0)],
+    "C.LUI": [(imm(), 0)],
+    "C.LWSP": [(rd(), 0)],
+    "C.JR": [(rs1(), 0)],
+    # C.EBREAK encoding
+    "C.JALR": [(rs1(), 0)]
+}
+
 # ##################################################################################################
 
 class BitsCopy:
@@ -656,17 +805,27 @@ class BitsCopy:
             if self.srcLo != self.srcHi:
                 raise Exception("Replication count can be specified for 1-bit source only")
         self.numReplicate = numReplicate
+        # Precompiled extraction: source shift and mask for the extracted value
+        self.shift = self.srcLo
+        self.mask = (1 << (self.srcHi - self.srcLo + 1)) - 1
 
-    def CopyFromBitString(self, s):
+    def GetSize(self):
         """
-        :param s: Source bit string.
-        :return: Slice with corresponding bits.
+        :return: Number of bits produced.
         """
-        if len(s) != 16:
-            raise Exception("Expected 16 bits bit-string")
         if self.numReplicate is not None:
-            return s[15 - self.srcHi] * self.numReplicate
-        return s[15-self.srcHi:16-self.srcLo]
+            return self.numReplicate
+        return self.srcHi - self.srcLo + 1
+
+    def Copy(self, opcode16):
+        """
+        :param opcode16: Source opcode as integer.
+        :return: Value with corresponding bits, GetSize() bits wide.
+        """
+        value = (opcode16 >> self.shift) & self.mask
+        if self.numReplicate is not None and value != 0:
+            return (1 << self.numReplicate) - 1
+        return value
 
 
 class CommandTransform:
@@ -710,6 +869,7 @@ class CommandTransform:
 
         self._FoldReplications()
         self._FoldConstantBits()
+        self._Compile()
 
     def _HandleImmediateChunk(self, c):
         if self.srcCmd.immHiBit is None:
@@ -782,21 +942,22 @@ class CommandTransform:
     def _FoldReplications(self):
         # Fold several adjacent bits replications into one component
         out = []
-        s = None
+        bits = None
 
         def Commit():
-            nonlocal s
-            if s is None:
+            nonlocal bits
+            if bits is None:
                 return
-            out.append(ConstantBits(s))
-            s = None
+            out.append(bits)
+            bits = None
 
         def Add(c):
-            nonlocal s
-            if s is None:
-                s = c.GetBitString()
+            nonlocal bits
+            if bits is None:
+                bits = c
             else:
-                s += c.GetBitString()
+                bits = ConstantBits._FromUnsigned(bits.size + c.size,
+                                                  (bits.value << c.size) | c.value)
 
         for c in self.components:
             if isinstance(c, ConstantBits):
@@ -839,23 +1000,78 @@ class CommandTransform:
         Commit()
         self.components = out
 
-    def Apply(self, opcode16):
-        """
-        :param opcode16: 16-bits opcode (bytes) to apply transform on.
-        :return 32-bits decompressed opcode (bytes).
+    def _Compile(self):
+        """Precompile components into constant value and list of tuples (shift, mask,
+        replicated value, destination position) for bits copying.
         """
-        s = ""
-        opcode16String = ConstantBits.FromInt(16, opcode16[0] << 8 | opcode16[1]).GetBitString()
+        self.constantValue = 0
+        self.copyOps = []
+        pos = 32
         for c in self.components:
             if isinstance(c, ConstantBits):
-                s += c.GetBitString()
+                pos -= c.size
+                self.constantValue |= c.value << pos
             elif isinstance(c, BitsCopy):
-                s += c.CopyFromBitString(opcode16String)
+                pos -= c.GetSize()
+                replicated = None if c.numReplicate is None else (1 << c.numReplicate) - 1
+                self.copyOps.append((c.shift, c.mask, replicated, pos))
             else:
                 raise Exception("Bad component type")
-        if len(s) != 32:
-            raise Exception(f"Unexpected result size: {len(s)}")
-        return BitStringToBytes(s)
+        if pos != 0:
+            raise Exception(f"Unexpected result size: {32 - pos}")
+
+    def GetBitSources(self):
+        """
+        :return: List indexed by output bit index, element is tuple ("const", bit value) or
+        ("in", source bit index).
+        """
+        sources = [None] * 32
+        pos = 32
+        for c in self.components:
+            if isinstance(c, ConstantBits):
+                for i in range(c.size):
+                    pos -= 1
+                    sources[pos] = ("const", (c.value >> (c.size - 1 - i)) & 1)
+            else:
+                for i in range(c.GetSize()):
+                    pos -= 1
+                    srcBit = c.srcHi if c.numReplicate is not None else c.srcHi - i
+                    sources[pos] = ("in", srcBit)
+        return sources
+
+    def ApplyInt(self, opcode16):
+        """
+        :param opcode16: 16-bits opcode (integer) to apply transform on.
+        :return 32-bits decompressed opcode (integer).
+        """
+        result = self.constantValue
+        for shift, mask, replicated, pos in self.copyOps:
+            value = (opcode16 >> shift) & mask
+            if replicated is not None and value != 0:
+                value = replicated
+            result |= value << pos
+        return result
+
+    def ApplyMany(self, opcodes16):
+        """
+        :param opcodes16: NumPy integer array of 16-bits opcodes to apply transform on.
+        :return NumPy int64 array of 32-bits decompressed opcodes.
+        """
+        opcodes16 = opcodes16.astype(np.int64)
+        result = np.full(opcodes16.shape, self.constantValue, dtype=np.int64)
+        for shift, mask, replicated, pos in self.copyOps:
+            value = (opcodes16 >> shift) & mask
+            if replicated is not None:
+                value = np.where(value != 0, replicated, 0)
+            result |= value << pos
+        return result
+
+    def Apply(self, opcode16):
+        """
+        :param opcode16: 16-bits opcode (bytes) to apply transform on.
+        :return 32-bits decompressed opcode (bytes).
+        """
+        return self.ApplyInt(opcode16[0] << 8 | opcode16[1]).to_bytes(4, "big")
 
     def GenerateVerilogExpression(self, inputVarName):
         """
@@ -892,77 +1108,979 @@ class CommandTransform:
         return s
 
 
-def Assemble(commandText, isCompressed):
+# Compiled CommandTransform for each compressed command description, shared by all the users
+commandTransforms = {}
+
+
+def GetCommandTransform(cmd16Desc):
     """
-    :param commandText: Command test in assembler language.
-    :param embeddedTarget: True to target RV32E, false for RV32I.
-    :return bytes for the command.
+    :return: CommandTransform for the compressed command. It is constructed once per command.
+    """
+    t = commandTransforms.get(cmd16Desc)
+    if t is None:
+        # May be called from worker threads, so the first stored instance wins
+        t = commandTransforms.setdefault(cmd16Desc, CommandTransform(cmd16Desc))
+    return t
+
+
+class Profiler:
+    """Collects wall and CPU time of generation phases, and external tools invocations statistics.
+    """
+    def __init__(self) -> None:
+        # Phase name to [wall time, CPU time] in seconds. Nested phase names are prefixed with the
+        # outer phase name.
+        self.phases = {}
+        self.phaseStack = []
+        # Tool name to [number of invocations, total wall time in seconds]
+        self.tools = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def Phase(self, name):
+        self.phaseStack.append(name)
+        fullName = "/".join(self.phaseStack)
+        startWall = time.perf_counter()
+        startCpu = time.process_time()
+        try:
+            yield
+        finally:
+            times = self.phases.setdefault(fullName, [0, 0])
+            times[0] += time.perf_counter() - startWall
+            times[1] += time.process_time() - startCpu
+            self.phaseStack.pop()
+
+    def AddToolRun(self, toolName, elapsed):
+        """Called from worker threads."""
+        with self.lock:
+            stats = self.tools.setdefault(toolName, [0, 0])
+            stats[0] += 1
+            stats[1] += elapsed
+
+    def ToJson(self):
+        return {
+            "phases": {name: {"wall": wall, "cpu": cpu}
+                       for name, (wall, cpu) in self.phases.items()},
+            "tools": {name: {"runs": runs, "time": elapsed}
+                      for name, (runs, elapsed) in self.tools.items()},
+            "toolRuns": sum(runs for runs, _ in self.tools.values())
+        }
+
+    def GetSummary(self):
+        s = "Profile (nested phases are included in the outer ones):\n"
+        s += f"    {'Phase':<40} {'Wall, s':>9} {'CPU, s':>9}\n"
+        for name, (wall, cpu) in self.phases.items():
+            s += f"    {name:<40} {wall:>9.3f} {cpu:>9.3f}\n"
+        s += f"    Tool runs: {sum(runs for runs, _ in self.tools.values())}"
+        for name, (runs, elapsed) in self.tools.items():
+            s += f"\n        {name}: {runs} runs, {elapsed:.3f} s"
+        return s
+
+
+def ProfilePhase(name):
+    """
+    :return: Context manager for profiling the named phase, does nothing if profiling is disabled.
+    """
+    if profiler is None:
+        return contextlib.nullcontext()
+    return profiler.Phase(name)
+
+
+def RunTool(cmdLine, **kwargs):
+    """subprocess.run() wrapper which accounts invocations in the profiler.
+    """
+    startTime = time.perf_counter()
+    try:
+        return subprocess.run(cmdLine, **kwargs)
+    finally:
+        if profiler is not None:
+            profiler.AddToolRun(os.path.basename(cmdLine[0]), time.perf_counter() - startTime)
+
+
+# Distance between adjacent commands in a batch translation unit. Each command is placed at its own
+# fixed offset so that disassembled opcodes can be mapped back to the commands.
+ASM_BATCH_STRIDE = 4
+
+objdumpLinePat = re.compile(r"^\s*([0-9a-f]+):\s+((?:[a-f0-9]{2}\s)+).*$")
+
+
+def _RunToolchain(code, isCompressed):
+    """Assemble the provided code and disassemble the resulting object file.
+    :param code: Assembler source text.
+    :param isCompressed: True to target RV32EC, false for RV32E.
+    :return: List of tuples (offset, opcode bytes, disassembly line).
     """
+    # Unique file name per invocation, so that concurrent runs do not overwrite each other files
+    fd, objFile = tempfile.mkstemp(prefix="decomp_test_", suffix=".o")
+    os.close(fd)
+    try:
+        RunTool([args.compiler, "-c", "--target=riscv32",
+                 "-march=rv32e" + ("c" if isCompressed else ""),
+                 "-mno-relax", "-mlittle-endian", "-x", "assembler", "-o", objFile, "-"],
+                input=code.encode("UTF-8"), check=True)
+        p = RunTool([args.objdump, "--disassemble", objFile], check=True, capture_output=True)
+    finally:
+        os.remove(objFile)
+
+    result = []
+    for line in p.stdout.decode("utf-8").splitlines():
+        m = objdumpLinePat.fullmatch(line)
+        if m is None:
+            continue
+        result.append((int(m.group(1), base=16),
+                       bytes(reversed([int(h, base=16) for h in m.group(2).split()])),
+                       line))
+    return result
 
+
+def _AssembleSingle(commandText, isCompressed):
+    """
+    :return: Tuple (opcode bytes, disassembly line) for the command.
+    """
     code = f"""
 .text
 {commandText}
     """
-    objFile = "/tmp/decomp_test.o"
-    subprocess.run([args.compiler, "-c", "--target=riscv32",
-                    "-march=rv32e" + ("c" if isCompressed else ""),
-                    "-mno-relax", "-mlittle-endian", "-x", "assembler", "-o", objFile, "-"],
-                   input=code.encode("UTF-8"), check=True)
+    opcodes = _RunToolchain(code, isCompressed)
+    if len(opcodes) == 0:
+        raise Exception("Failed to find compiled opcodes")
+    return opcodes[0][1:]
+
+
+def Assemble(commandText, isCompressed):
+    """
+    :param commandText: Command test in assembler language.
+    :param isCompressed: True to target RV32EC, false for RV32E.
+    :return bytes for the command.
+    """
+    opcode, line = _AssembleSingle(commandText, isCompressed)
+    print(line)
+    return opcode
+
+
+def AssembleBatch(commandTexts, isCompressed):
+    """Assemble several commands in one translation unit, so the toolchain is invoked only once.
+    :param commandTexts: List of commands texts in assembler language.
+    :param isCompressed: True to target RV32EC, false for RV32E.
+    :return: List of tuples (opcode bytes, disassembly line), in the same order as commandTexts.
+    """
+    if len(commandTexts) == 0:
+        return []
+    code = ".text\n"
+    for idx, commandText in enumerate(commandTexts):
+        code += f".org {idx * ASM_BATCH_STRIDE}\n{commandText}\n"
+
+    # Offset to (opcode, line). Padding between commands is disassembled as well, it is skipped
+    # since it never starts at command offset.
+    opcodes = {}
+    for offset, opcode, line in _RunToolchain(code, isCompressed):
+        if offset % ASM_BATCH_STRIDE == 0:
+            opcodes[offset] = (opcode, line)
+
+    result = []
+    for idx, commandText in enumerate(commandTexts):
+        opcode = opcodes.get(idx * ASM_BATCH_STRIDE)
+        if opcode is None:
+            raise Exception(f"Failed to find compiled opcodes for `{commandText}`")
+        result.append(opcode)
+    return result
+
+
+class ReferenceEncoder:
+    """Built-in encoder for the RV32EC subset used by the decompressor. It is written directly from
+    the instruction formats in RISC-V specification and does not use the declarative commands
+    description, so it can serve as an independent oracle for self-testing without the external
+    toolchain. Base commands are compressed when possible, same way as the LLVM assembler does.
+    """
+
+    class Operand:
+        def __init__(self, text) -> None:
+            self.text = text
+            # Register index if register or memory reference operand
+            self.reg = None
+            # Immediate value if immediate or memory reference operand
+            self.imm = None
+            m = re.fullmatch(r"x(\d+)", text)
+            if m is not None:
+                self.reg = ReferenceEncoder._ParseReg(m.group(1))
+                return
+            m = re.fullmatch(r"([-+]?\w+)\(x(\d+)\)", text)
+            if m is not None:
+                self.imm = int(m.group(1), base=0)
+                self.reg = ReferenceEncoder._ParseReg(m.group(2))
+                return
+            try:
+                self.imm = int(text, base=0)
+            except ValueError:
+                raise Exception(f"Cannot parse operand: `{text}`") from None
+
+        def IsReg(self):
+            return self.reg is not None and self.imm is None
+
+        def IsImm(self):
+            return self.reg is None and self.imm is not None
+
+        def IsMem(self):
+            return self.reg is not None and self.imm is not None
+
+    def __init__(self) -> None:
+        # Mnemonic to tuple (operands kinds string, encoding function). Kinds: "r" - register,
+        # "i" - immediate, "m" - memory reference.
+        self.encoders = {
+            "LW": ("rm", lambda o: self._EncodeI(o[0].reg, o[1].reg, o[1].imm, 0b010, 0b0000011)),
+            "SW": ("rm", lambda o: self._EncodeS(o[0].reg, o[1].reg, o[1].imm, 0b010, 0b0100011)),
+            "JAL": ("ri", lambda o: self._EncodeJ(o[0].reg, o[1].imm, 0b1101111)),
+            "JALR": ("rri", lambda o: self._EncodeI(o[0].reg, o[1].reg, o[2].imm, 0b000,
+                                                    0b1100111)),
+            "BEQ": ("rri", lambda o: self._EncodeB(o[0].reg, o[1].reg, o[2].imm, 0b000, 0b1100011)),
+            "BNE": ("rri", lambda o: self._EncodeB(o[0].reg, o[1].reg, o[2].imm, 0b001, 0b1100011)),
+            "ADDI": ("rri", lambda o: self._EncodeI(o[0].reg, o[1].reg, o[2].imm, 0b000,
+                                                    0b0010011)),
+            "LUI": ("ri", lambda o: self._EncodeU(o[0].reg, o[1].imm, 0b0110111)),
+            "SLLI": ("rri", lambda o: self._EncodeShift(o, 0b0000000, 0b001)),
+            "SRLI": ("rri", lambda o: self._EncodeShift(o, 0b0000000, 0b101)),
+            "SRAI": ("rri", lambda o: self._EncodeShift(o, 0b0100000, 0b101)),
+            "ANDI": ("rri", lambda o: self._EncodeI(o[0].reg, o[1].reg, o[2].imm, 0b111,
+                                                    0b0010011)),
+            "ADD": ("rrr", lambda o: self._EncodeR(o, 0b0000000, 0b000)),
+            "SUB": ("rrr", lambda o: self._EncodeR(o, 0b0100000, 0b000)),
+            "XOR": ("rrr", lambda o: self._EncodeR(o, 0b0000000, 0b100)),
+            "OR": ("rrr", lambda o: self._EncodeR(o, 0b0000000, 0b110)),
+            "AND": ("rrr", lambda o: self._EncodeR(o, 0b0000000, 0b111)),
+
+            "C.ADDI4SPN": ("rri", self._EncodeCAddi4spn),
+            "C.LW": ("rm", lambda o: self._EncodeCLoadStore(o, 0b010)),
+            "C.SW": ("rm", lambda o: self._EncodeCLoadStore(o, 0b110)),
+            "C.NOP": ("", lambda o: self._Pack((0b000, 3), (0, 1), (0, 5), (0, 5), (0b01, 2))),
+            "C.ADDI": ("ri", lambda o: self._EncodeCI(o, 0b000, isNonZero=True)),
+            "C.JAL": ("i", lambda o: self._EncodeCJ(o, 0b001)),
+            "C.LI": ("ri", lambda o: self._EncodeCI(o, 0b010)),
+            "C.ADDI16SP": ("ri", self._EncodeCAddi16sp),
+            "C.LUI": ("ri", self._EncodeCLui),
+            "C.SRLI": ("ri", lambda o: self._EncodeCShift(o, 0b00)),
+            "C.SRAI": ("ri", lambda o: self._EncodeCShift(o, 0b01)),
+            "C.ANDI": ("ri", self._EncodeCAndi),
+            "C.SUB": ("rr", lambda o: self._EncodeCArith(o, 0b00)),
+            "C.XOR": ("rr", lambda o: self._EncodeCArith(o, 0b01)),
+            "C.OR": ("rr", lambda o: self._EncodeCArith(o, 0b10)),
+            "C.AND": ("rr", lambda o: self._EncodeCArith(o, 0b11)),
+            "C.J": ("i", lambda o: self._EncodeCJ(o, 0b101)),
+            "C.BEQZ": ("ri", lambda o: self._EncodeCBranch(o, 0b110)),
+            "C.BNEZ": ("ri", lambda o: self._EncodeCBranch(o, 0b111)),
+            "C.SLLI": ("ri", self._EncodeCSlli),
+            "C.LWSP": ("rm", self._EncodeCLwsp),
+            "C.JR": ("r", lambda o: self._EncodeCJumpReg(o, 0)),
+            "C.MV": ("rr", lambda o: self._EncodeCRegReg(o, 0)),
+            "C.JALR": ("r", lambda o: self._EncodeCJumpReg(o, 1)),
+            "C.ADD": ("rr", lambda o: self._EncodeCRegReg(o, 1)),
+            "C.SWSP": ("rm", self._EncodeCSwsp),
+        }
+
+    def Assemble(self, commandText, isCompressed):
+        """
+        :param commandText: Command text in assembler language.
+        :param isCompressed: True to target RV32EC, false for RV32E.
+        :return: Tuple (opcode bytes, disassembly line).
+        """
+        mnemonic, operands = self._Parse(commandText)
+        if isCompressed and not mnemonic.startswith("C."):
+            compressed = self._Compress(mnemonic, operands)
+            if compressed is not None:
+                mnemonic, operands = self._Parse(compressed)
+        elif not isCompressed and mnemonic.startswith("C."):
+            raise Exception(f"Compressed command for non-compressed target: `{commandText}`")
+
+        opcode = self.encoders[mnemonic][1](operands)
+        size = 2 if mnemonic.startswith("C.") else 4
+        opcode = opcode.to_bytes(size, "big")
+        text = mnemonic.lower() + " " + ", ".join(o.text for o in operands)
+        return opcode, f"{bytes(reversed(opcode)).hex(' '):<12}\t{text.strip()}"
+
+    def _Parse(self, commandText):
+        """
+        :return: Tuple (mnemonic, list of operands).
+        """
+        mnemonic, _, operandsText = commandText.strip().partition(" ")
+        mnemonic = mnemonic.upper()
+        if mnemonic not in self.encoders:
+            raise Exception(f"Unsupported command: `{commandText}`")
+        operands = []
+        if len(operandsText.strip()) > 0:
+            operands = [ReferenceEncoder.Operand(o.strip()) for o in operandsText.split(",")]
+        kinds = self.encoders[mnemonic][0]
+        if len(operands) != len(kinds):
+            raise Exception(f"Wrong number of operands: `{commandText}`")
+        for o, kind in zip(operands, kinds):
+            if ((kind == "r" and not o.IsReg()) or (kind == "i" and not o.IsImm()) or
+                (kind == "m" and not o.IsMem())):
+                raise Exception(f"Bad operand `{o.text}` in `{commandText}`")
+        return mnemonic, operands
+
+    @staticmethod
+    def _Compress(mnemonic, o):
+        """Find compressed equivalent of the base command. Rules and their order follow the LLVM
+        compression patterns, so that the result matches the toolchain output.
+        :return: Compressed command text, None if the command cannot be compressed.
+        """
+        def IsC(reg):
+            return 8 <= reg <= 15
+
+        def FitsSigned(v, bits, align=0):
+            return -(1 << (bits - 1)) <= v < (1 << (bits - 1)) and v % (1 << align) == 0
+
+        def FitsUnsigned(v, bits, align=0):
+            return 0 <= v < (1 << bits) and v % (1 << align) == 0
+
+        if mnemonic == "ADDI":
+            rd, rs1, v = o[0].reg, o[1].reg, o[2].imm
+            if IsC(rd) and rs1 == 2 and v != 0 and FitsUnsigned(v, 10, 2):
+                return f"C.ADDI4SPN x{rd}, x2, {v}"
+            if rd == 0 and rs1 == 0 and v == 0:
+                return "C.NOP"
+            if rd != 0 and rd == rs1 and v != 0 and FitsSigned(v, 6):
+                return f"C.ADDI x{rd}, {v}"
+            if rd != 0 and rs1 == 0 and FitsSigned(v, 6):
+                return f"C.LI x{rd}, {v}"
+            if rd == 2 and rs1 == 2 and v != 0 and FitsSigned(v, 10, 4):
+                return f"C.ADDI16SP x2, {v}"
+            if rd != 0 and rs1 != 0 and v == 0:
+                return f"C.MV x{rd}, x{rs1}"
+        elif mnemonic == "LW":
+            rd, rs1, v = o[0].reg, o[1].reg, o[1].imm
+            if IsC(rd) and IsC(rs1) and FitsUnsigned(v, 7, 2):
+                return f"C.LW x{rd}, {v}(x{rs1})"
+            if rd != 0 and rs1 == 2 and FitsUnsigned(v, 8, 2):
+                return f"C.LWSP x{rd}, {v}(x2)"
+        elif mnemonic == "SW":
+            rs2, rs1, v = o[0].reg, o[1].reg, o[1].imm
+            if IsC(rs2) and IsC(rs1) and FitsUnsigned(v, 7, 2):
+                return f"C.SW x{rs2}, {v}(x{rs1})"
+            if rs1 == 2 and FitsUnsigned(v, 8, 2):
+                return f"C.SWSP x{rs2}, {v}(x2)"
+        elif mnemonic == "JAL":
+            rd, v = o[0].reg, o[1].imm
+            if rd in (0, 1) and FitsSigned(v, 12, 1):
+                return f"{'C.JAL' if rd == 1 else 'C.J'} {v}"
+        elif mnemonic == "LUI":
+            rd, v = o[0].reg, o[1].imm
+            if rd not in (0, 2) and (1 <= v <= 0x1f or 0xfffe0 <= v <= 0xfffff):
+                return f"C.LUI x{rd}, {v}"
+        elif mnemonic in ("SRLI", "SRAI"):
+            rd, rs1, v = o[0].reg, o[1].reg, o[2].imm
+            if IsC(rd) and rd == rs1 and v != 0 and FitsUnsigned(v, 5):
+                return f"C.{mnemonic} x{rd}, {v}"
+        elif mnemonic == "SLLI":
+            rd, rs1, v = o[0].reg, o[1].reg, o[2].imm
+            if rd != 0 and rd == rs1 and v != 0 and FitsUnsigned(v, 5):
+                return f"C.SLLI x{rd}, {v}"
+        elif mnemonic == "ANDI":
+            rd, rs1, v = o[0].reg, o[1].reg, o[2].imm
+            if IsC(rd) and rd == rs1 and FitsSigned(v, 6):
+                return f"C.ANDI x{rd}, {v}"
+        elif mnemonic in ("SUB", "XOR", "OR", "AND"):
+            rd, rs1, rs2 = o[0].reg, o[1].reg, o[2].reg
+            if IsC(rd) and IsC(rs1) and IsC(rs2):
+                if rd == rs1:
+                    return f"C.{mnemonic} x{rd}, x{rs2}"
+                if rd == rs2 and mnemonic != "SUB":
+                    return f"C.{mnemonic} x{rd}, x{rs1}"
+        elif mnemonic in ("BEQ", "BNE"):
+            rs1, rs2, v = o[0].reg, o[1].reg, o[2].imm
+            if IsC(rs1) and rs2 == 0 and FitsSigned(v, 9, 1):
+                return f"{'C.BEQZ' if mnemonic == 'BEQ' else 'C.BNEZ'} x{rs1}, {v}"
+        elif mnemonic == "JALR":
+            rd, rs1, v = o[0].reg, o[1].reg, o[2].imm
+            if rd in (0, 1) and rs1 != 0 and v == 0:
+                return f"{'C.JALR' if rd == 1 else 'C.JR'} x{rs1}"
+        elif mnemonic == "ADD":
+            rd, rs1, rs2 = o[0].reg, o[1].reg, o[2].reg
+            if rd != 0 and rs1 == 0 and rs2 != 0:
+                return f"C.MV x{rd}, x{rs2}"
+            if rd != 0 and rs1 != 0 and rs2 == 0:
+                return f"C.MV x{rd}, x{rs1}"
+            if rd != 0 and rd == rs1 and rs2 != 0:
+                return f"C.ADD x{rd}, x{rs2}"
+            if rd != 0 and rd == rs2 and rs1 != 0:
+                return f"C.ADD x{rd}, x{rs1}"
+        return None
+
+    @staticmethod
+    def _ParseReg(s):
+        reg = int(s)
+        if reg > 15:
+            raise Exception(f"Register is not available in RV32E: x{reg}")
+        return reg
+
+    @staticmethod
+    def _CheckImm(v, bits, isSigned=True, align=0, isNonZero=False):
+        """Check immediate value range and alignment.
+        :return: The value truncated to the specified number of bits.
+        """
+        if isSigned:
+            isValid = -(1 << (bits - 1)) <= v < (1 << (bits - 1))
+        else:
+            isValid = 0 <= v < (1 << bits)
+        if not isValid or v % (1 << align) != 0 or (isNonZero and v == 0):
+            raise Exception(f"Immediate value out of range: {v}")
+        return v & ((1 << bits) - 1)
+
+    @staticmethod
+    def _CheckCReg(reg):
+        """
+        :return: 3 bits register field for compressed command.
+        """
+        if reg < 8 or reg > 15:
+            raise Exception(f"Register not encodable in compressed field: x{reg}")
+        return reg - 8
 
-    p = subprocess.run([args.objdump, "--disassemble", objFile],
-                       check=True, capture_output=True)
+    @staticmethod
+    def _Pack(*fields):
+        """
+        :param fields: Tuples (value, size in bits), MSB first.
+        """
+        result = 0
+        for value, size in fields:
+            result = (result << size) | (value & ((1 << size) - 1))
+        return result
 
-    output = p.stdout.decode("utf-8")
-    pat = re.compile(r"^\s*\d+:\s+((?:[a-f0-9]{2}\s)+).*$")
+    @staticmethod
+    def _Scatter(v, layout):
+        """Compose immediate bits in the order specified by layout.
+        :param layout: Bits layout as in specification, e.g. "5:4|9:6|2|3".
+        :return: Tuple (value, size in bits) suitable for _Pack().
+        """
+        result = 0
+        size = 0
+        for chunk in layout.split("|"):
+            hiBit, _, loBit = chunk.partition(":")
+            hiBit = int(hiBit)
+            loBit = int(loBit) if len(loBit) > 0 else hiBit
+            chunkSize = hiBit - loBit + 1
+            result = (result << chunkSize) | ((v >> loBit) & ((1 << chunkSize) - 1))
+            size += chunkSize
+        return result, size
+
+    # 32 bits formats
+
+    def _EncodeR(self, o, funct7, funct3):
+        return self._Pack((funct7, 7), (o[2].reg, 5), (o[1].reg, 5), (funct3, 3), (o[0].reg, 5),
+                          (0b0110011, 7))
+
+    def _EncodeI(self, rd, rs1, v, funct3, opcode):
+        v = self._CheckImm(v, 12)
+        return self._Pack((v, 12), (rs1, 5), (funct3, 3), (rd, 5), (opcode, 7))
+
+    def _EncodeShift(self, o, funct7, funct3):
+        v = self._CheckImm(o[2].imm, 5, isSigned=False)
+        return self._Pack((funct7, 7), (v, 5), (o[1].reg, 5), (funct3, 3), (o[0].reg, 5),
+                          (0b0010011, 7))
+
+    def _EncodeS(self, rs2, rs1, v, funct3, opcode):
+        v = self._CheckImm(v, 12)
+        return self._Pack(self._Scatter(v, "11:5"), (rs2, 5), (rs1, 5), (funct3, 3),
+                          self._Scatter(v, "4:0"), (opcode, 7))
+
+    def _EncodeB(self, rs1, rs2, v, funct3, opcode):
+        v = self._CheckImm(v, 13, align=1)
+        return self._Pack(self._Scatter(v, "12|10:5"), (rs2, 5), (rs1, 5), (funct3, 3),
+                          self._Scatter(v, "4:1|11"), (opcode, 7))
+
+    def _EncodeU(self, rd, v, opcode):
+        v = self._CheckImm(v, 20, isSigned=False)
+        return self._Pack((v, 20), (rd, 5), (opcode, 7))
+
+    def _EncodeJ(self, rd, v, opcode):
+        v = self._CheckImm(v, 21, align=1)
+        return self._Pack(self._Scatter(v, "20|10:1|11|19:12"), (rd, 5), (opcode, 7))
+
+    # 16 bits formats
+
+    def _EncodeCAddi4spn(self, o):
+        if o[1].reg != 2:
+            raise Exception("C.ADDI4SPN source register must be x2")
+        v = self._CheckImm(o[2].imm, 10, isSigned=False, align=2, isNonZero=True)
+        return self._Pack((0b000, 3), self._Scatter(v, "5:4|9:6|2|3"),
+                          (self._CheckCReg(o[0].reg), 3), (0b00, 2))
+
+    def _EncodeCLoadStore(self, o, funct3):
+        v = self._CheckImm(o[1].imm, 7, isSigned=False, align=2)
+        return self._Pack((funct3, 3), self._Scatter(v, "5:3"), (self._CheckCReg(o[1].reg), 3),
+                          self._Scatter(v, "2|6"), (self._CheckCReg(o[0].reg), 3), (0b00, 2))
+
+    def _EncodeCI(self, o, funct3, isNonZero=False):
+        if o[0].reg == 0:
+            raise Exception("Destination register cannot be x0")
+        v = self._CheckImm(o[1].imm, 6, isNonZero=isNonZero)
+        return self._Pack((funct3, 3), self._Scatter(v, "5"), (o[0].reg, 5),
+                          self._Scatter(v, "4:0"), (0b01, 2))
+
+    def _EncodeCJ(self, o, funct3):
+        v = self._CheckImm(o[0].imm, 12, align=1)
+        return self._Pack((funct3, 3), self._Scatter(v, "11|4|9:8|10|6|7|3:1|5"), (0b01, 2))
+
+    def _EncodeCAddi16sp(self, o):
+        if o[0].reg != 2:
+            raise Exception("C.ADDI16SP destination register must be x2")
+        v = self._CheckImm(o[1].imm, 10, align=4, isNonZero=True)
+        return self._Pack((0b011, 3), self._Scatter(v, "9"), (2, 5), self._Scatter(v, "4|6|8:7|5"),
+                          (0b01, 2))
+
+    def _EncodeCLui(self, o):
+        if o[0].reg in (0, 2):
+            raise Exception("C.LUI destination register cannot be x0 or x2")
+        v = o[1].imm
+        if not (1 <= v <= 0x1f or 0xfffe0 <= v <= 0xfffff):
+            raise Exception(f"Immediate value out of range: {v}")
+        return self._Pack((0b011, 3), self._Scatter(v, "5"), (o[0].reg, 5),
+                          self._Scatter(v, "4:0"), (0b01, 2))
+
+    def _EncodeCShift(self, o, funct2):
+        v = self._CheckImm(o[1].imm, 5, isSigned=False, isNonZero=True)
+        return self._Pack((0b100, 3), (0, 1), (funct2, 2), (self._CheckCReg(o[0].reg), 3),
+                          (v, 5), (0b01, 2))
+
+    def _EncodeCAndi(self, o):
+        v = self._CheckImm(o[1].imm, 6)
+        return self._Pack((0b100, 3), self._Scatter(v, "5"), (0b10, 2),
+                          (self._CheckCReg(o[0].reg), 3), self._Scatter(v, "4:0"), (0b01, 2))
+
+    def _EncodeCArith(self, o, funct2):
+        return self._Pack((0b100, 3), (0, 1), (0b11, 2), (self._CheckCReg(o[0].reg), 3),
+                          (funct2, 2), (self._CheckCReg(o[1].reg), 3), (0b01, 2))
+
+    def _EncodeCBranch(self, o, funct3):
+        v = self._CheckImm(o[1].imm, 9, align=1)
+        return self._Pack((funct3, 3), self._Scatter(v, "8|4:3"), (self._CheckCReg(o[0].reg), 3),
+                          self._Scatter(v, "7:6|2:1|5"), (0b01, 2))
+
+    def _EncodeCSlli(self, o):
+        if o[0].reg == 0:
+            raise Exception("Destination register cannot be x0")
+        v = self._CheckImm(o[1].imm, 5, isSigned=False, isNonZero=True)
+        return self._Pack((0b000, 3), (0, 1), (o[0].reg, 5), (v, 5), (0b10, 2))
+
+    def _EncodeCLwsp(self, o):
+        if o[0].reg == 0:
+            raise Exception("Destination register cannot be x0")
+        if o[1].reg != 2:
+            raise Exception("C.LWSP base register must be x2")
+        v = self._CheckImm(o[1].imm, 8, isSigned=False, align=2)
+        return self._Pack((0b010, 3), self._Scatter(v, "5"), (o[0].reg, 5),
+                          self._Scatter(v, "4:2|7:6"), (0b10, 2))
+
+    def _EncodeCJumpReg(self, o, funct1):
+        if o[0].reg == 0:
+            raise Exception("Source register cannot be x0")
+        return self._Pack((0b100, 3), (funct1, 1), (o[0].reg, 5), (0, 5), (0b10, 2))
+
+    def _EncodeCRegReg(self, o, funct1):
+        if o[0].reg == 0 or o[1].reg == 0:
+            raise Exception("Register cannot be x0")
+        return self._Pack((0b100, 3), (funct1, 1), (o[0].reg, 5), (o[1].reg, 5), (0b10, 2))
+
+    def _EncodeCSwsp(self, o):
+        if o[1].reg != 2:
+            raise Exception("C.SWSP base register must be x2")
+        v = self._CheckImm(o[1].imm, 8, isSigned=False, align=2)
+        return self._Pack((0b110, 3), self._Scatter(v, "5:2|7:6"), (o[0].reg, 5), (0b10, 2))
+
+
+# Shared instance, the encoder has no mutable state
+referenceEncoder = ReferenceEncoder()
+
+
+def SetReplacementMode(tmpPath, targetPath):
+    """Temporary files are created accessible by the owner only. Set the mode the target file
+    would have if written directly: mode of the existing target, or default mode for the current
+    umask.
+    """
     try:
-        for line in output.splitlines():
-            m = pat.fullmatch(line)
-            if m is None:
-                continue
-            print(line)
-            return bytes(reversed([int(h, base=16) for h in m.group(1).split()]))
-        raise Exception("Failed to find compiled opcodes")
-    finally:
-        os.remove(objFile)
+        mode = stat.S_IMODE(os.stat(targetPath).st_mode)
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    os.chmod(tmpPath, mode)
+
+
+class AsmCache:
+    """Persistent cache of assembled opcodes. Entries are addressed by hash of the command text,
+    target architecture and toolchain identity, so any toolchain update invalidates them. Least
+    recently used entries are evicted when the cache grows over the size limit.
+    """
+    VERSION = 1
 
+    def __init__(self, path, maxEntries) -> None:
+        """
+        :param path: Cache file path.
+        :param maxEntries: Maximal number of entries to keep.
+        """
+        self.path = path
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+        # Key to dictionary with "opcode", "line" and "lastUsed"
+        self.entries = {}
+        # Tool stat signature to version string
+        self.toolVersions = {}
+        # Incremented on each access, used for LRU ordering
+        self.useCounter = 0
+        self.toolchainId = None
+        # Set when new entries are stored, the file is not rewritten otherwise
+        self.isModified = False
+        self._Load()
+
+    def _Load(self):
+        """Load the cache file. Cache is left empty if the file is missing, corrupted or has
+        unexpected content.
+        """
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(data, dict) or data.get("version") != AsmCache.VERSION:
+            return
+        entries = data.get("entries")
+        toolVersions = data.get("toolVersions")
+        useCounter = data.get("useCounter")
+        if not isinstance(entries, dict) or not isinstance(toolVersions, dict) or \
+            not isinstance(useCounter, int):
+            return
+        if not all(AsmCache._IsValidEntry(entry) for entry in entries.values()) or \
+            not all(isinstance(version, str) for version in toolVersions.values()):
+            return
+        self.entries = entries
+        self.toolVersions = toolVersions
+        self.useCounter = useCounter
 
-def DoSelfTest():
-    for cmdName in commands16.keys():
-        print(f"\n========================= {cmdName} =========================")
-        cmd = commands16[cmdName]
-        tcs = cmd.GenerateTestCases()
-        for tc in tcs:
-            print(f"[{cmd}] {tc}")
-            asm = cmd.GenerateAsm(tc)
-            print(asm)
-            asmB = Assemble(asm, True)
-            opc = cmd.GenerateOpcode(tc)
+    @staticmethod
+    def _IsValidEntry(entry):
+        if not isinstance(entry, dict) or not isinstance(entry.get("opcode"), str) or \
+            not isinstance(entry.get("line"), str) or not isinstance(entry.get("lastUsed"), int):
+            return False
+        try:
+            bytes.fromhex(entry["opcode"])
+        except ValueError:
+            return False
+        return True
+
+    def Save(self):
+        with self.lock:
+            if not self.isModified:
+                # Only usage counters changed, not worth rewriting the whole file
+                return
+            if len(self.entries) > self.maxEntries:
+                keys = sorted(self.entries.keys(), key=lambda k: self.entries[k]["lastUsed"])
+                for key in keys[:len(self.entries) - self.maxEntries]:
+                    del self.entries[key]
+            data = {
+                "version": AsmCache.VERSION,
+                "useCounter": self.useCounter,
+                "toolVersions": self.toolVersions,
+                "entries": self.entries
+            }
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # Write to temporary file first, so that concurrent runs never see partial file
+            fd, tmpPath = tempfile.mkstemp(prefix=os.path.basename(self.path),
+                                           dir=os.path.dirname(self.path))
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f)
+                SetReplacementMode(tmpPath, self.path)
+                os.replace(tmpPath, self.path)
+            except:
+                os.remove(tmpPath)
+                raise
+            self.isModified = False
+
+    def _GetToolIdentity(self, toolPath):
+        """
+        :return: String which identifies the tool: resolved path and version. Version is taken from
+        the cache when the tool file is not modified, so no tool invocation is needed.
+        """
+        resolvedPath, signature = GetToolSignature(toolPath)
+        version = self.toolVersions.get(signature)
+        if version is None:
+            p = RunTool([resolvedPath, "--version"], check=True, capture_output=True)
+            version = p.stdout.decode("utf-8").strip()
+            self.toolVersions[signature] = version
+        return f"{resolvedPath}\n{version}"
+
+    def GetKey(self, commandText, isCompressed):
+        with self.lock:
+            if self.toolchainId is None:
+                self.toolchainId = (self._GetToolIdentity(args.compiler) + "\n" +
+                                    self._GetToolIdentity(args.objdump))
+        march = "rv32e" + ("c" if isCompressed else "")
+        keyText = f"{self.toolchainId}\n{march}\n{commandText}"
+        return hashlib.sha256(keyText.encode("utf-8")).hexdigest()
+
+    def Lookup(self, key):
+        """
+        :return: Tuple (opcode bytes, disassembly line), None if not cached.
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.useCounter += 1
+            entry["lastUsed"] = self.useCounter
+            return bytes.fromhex(entry["opcode"]), entry["line"]
+
+    def Store(self, key, opcode, line):
+        with self.lock:
+            self.useCounter += 1
+            self.entries[key] = {"opcode": opcode.hex(), "line": line, "lastUsed": self.useCounter}
+            self.isModified = True
+
+
+def GetToolSignature(toolPath):
+    """
+    :return: Tuple (resolved tool path, signature string). Signature changes when the tool file is
+    replaced or modified. The tool is not invoked.
+    """
+    resolvedPath = shutil.which(toolPath)
+    if resolvedPath is None:
+        raise Exception(f"Tool not found: {toolPath}")
+    resolvedPath = os.path.realpath(resolvedPath)
+    st = os.stat(resolvedPath)
+    return resolvedPath, f"{resolvedPath}:{st.st_size}:{st.st_mtime_ns}"
+
+
+def GetDefaultAsmCachePath():
+    cacheHome = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cacheHome, "gen_decompressor", "asm_cache.json")
+
+
+def AssembleCommands(commandTexts, isCompressed):
+    """Assemble the commands using the oracle selected by command line arguments. Cached opcodes
+    are used if the cache is enabled.
+    :param commandTexts: List of commands texts in assembler language.
+    :param isCompressed: True to target RV32EC, false for RV32E.
+    :return: List of tuples (opcode bytes, disassembly line), in the same order as commandTexts.
+    """
+    if args.asmOracle == "builtin":
+        return [referenceEncoder.Assemble(commandText, isCompressed)
+                for commandText in commandTexts]
+
+    result = _AssembleWithToolchain(commandTexts, isCompressed)
+
+    if args.asmOracle == "both":
+        for commandText, (opcode, line) in zip(commandTexts, result):
+            refOpcode, _ = referenceEncoder.Assemble(commandText, isCompressed)
+            if refOpcode != opcode:
+                raise Exception(f"Reference encoder mismatch for `{commandText}`: " +
+                                f"{refOpcode.hex(' ')} vs toolchain {opcode.hex(' ')} ({line})")
+    return result
+
+
+def _AssembleWithToolchain(commandTexts, isCompressed):
+    result = [None] * len(commandTexts)
+    # Indices of commands not found in the cache
+    missing = []
+    if asmCache is not None:
+        keys = [asmCache.GetKey(commandText, isCompressed) for commandText in commandTexts]
+        for idx, key in enumerate(keys):
+            result[idx] = asmCache.Lookup(key)
+            if result[idx] is None:
+                missing.append(idx)
+    else:
+        missing = list(range(len(commandTexts)))
+
+    if len(missing) == 0:
+        return result
+
+    missingTexts = [commandTexts[idx] for idx in missing]
+    if args.noAsmBatch:
+        opcodes = [_AssembleSingle(commandText, isCompressed) for commandText in missingTexts]
+    else:
+        opcodes = AssembleBatch(missingTexts, isCompressed)
+
+    for idx, opcode in zip(missing, opcodes):
+        result[idx] = opcode
+        if asmCache is not None:
+            asmCache.Store(keys[idx], *opcode)
+    return result
+
+
+class SelfTestCase:
+    """Single self-test case: compressed command with bound arguments and the corresponding base
+    command.
+    """
+    def __init__(self, cmd, bindings) -> None:
+        self.cmd = cmd
+        self.bindings = bindings
+        self.baseCmd = cmd.mapTo.targetCmd
+        self.baseBindings = Bindings()
+        self.baseBindings.Extend(bindings)
+        self.baseBindings.Extend(cmd.mapTo.bindings)
+        self.asm = cmd.GenerateAsm(bindings)
+        self.baseAsm = self.baseCmd.GenerateAsm(self.baseBindings)
+
+
+def _SelfTestChunk(testCases):
+    """Verify the provided test cases. Called from worker threads, so nothing is printed directly.
+    :param testCases: List of SelfTestCase. Cases of one command should not be split between chunks.
+    :return: Tuple (log lines, exception or None if all the cases passed).
+    """
+    log = []
+    try:
+        # Compressed and base commands are assembled for compressed target, base commands also for
+        # full target.
+        opcodes = AssembleCommands([tc.asm for tc in testCases] +
+                                   [tc.baseAsm for tc in testCases], True)
+        compressedOpcodes = opcodes[:len(testCases)]
+        baseOpcodes = opcodes[len(testCases):]
+        fullOpcodes = AssembleCommands([tc.baseAsm for tc in testCases], False)
+
+        curCmd = None
+        for idx, tc in enumerate(testCases):
+            cmd = tc.cmd
+            if cmd is not curCmd:
+                log.append(f"\n========================= {cmd} =========================")
+                curCmd = cmd
+            log.append(f"[{cmd}] {tc.bindings}")
+            log.append(tc.asm)
+            asmB, line = compressedOpcodes[idx]
+            log.append(line)
+            opc = cmd.GenerateOpcode(tc.bindings)
             if asmB != opc:
                 raise Exception("Assembled opcode does not match the generated one: "  +
                                 f"{asmB.hex(' ')} vs {opc.hex(' ')}")
 
             # Compile base instruction
-            baseCmd = cmd.mapTo.targetCmd
-            baseBindings = Bindings()
-            baseBindings.Extend(tc)
-            baseBindings.Extend(cmd.mapTo.bindings)
-            print(baseBindings)
-            asm = baseCmd.GenerateAsm(baseBindings)
-            print(asm)
-            asmB = Assemble(asm, True)
+            log.append(str(tc.baseBindings))
+            log.append(tc.baseAsm)
+            asmB, line = baseOpcodes[idx]
+            log.append(line)
             if asmB != opc:
                 raise Exception("Assembled base opcode does not match the generated one: "  +
                                 f"{asmB.hex(' ')} vs {opc.hex(' ')}")
-            opc32 = baseCmd.GenerateOpcode(baseBindings)
-            asmB = Assemble(asm, False)
+            opc32 = tc.baseCmd.GenerateOpcode(tc.baseBindings)
+            asmB, line = fullOpcodes[idx]
+            log.append(line)
             if asmB != opc32:
                 raise Exception("Assembled full base opcode does not match the generated one: "  +
                                 f"{asmB.hex(' ')} vs {opc32.hex(' ')}")
 
-            t = CommandTransform(cmd)
+            t = GetCommandTransform(cmd)
             decompressed = t.Apply(opc)
             if decompressed != opc32:
-                raise Exception(f"Bad decompressed value: {decompressed.hex(' ')} != {opc32.hex(' ')}")
+                raise Exception(
+                    f"Bad decompressed value: {decompressed.hex(' ')} != {opc32.hex(' ')}")
+    except Exception as e:
+        return log, e
+    return log, None
+
+
+def _IsAssemblerTestable(tc):
+    """Check whether the test case can be verified by the assembler. Reserved and hint encodings
+    are rejected by the assembler, and some base commands are compressed to a different command
+    (e.g. `ADDI x2, x2, 16` becomes C.ADDI rather than C.ADDI16SP). The reference encoder follows
+    the assembler rules, so it is used as a cheap filter. The generated opcode is not involved.
+    """
+    try:
+        opc, _ = referenceEncoder.Assemble(tc.asm, True)
+        baseOpc, _ = referenceEncoder.Assemble(tc.baseAsm, True)
+    except Exception:
+        return False
+    return opc == baseOpc
+
+
+# Number of random test cases verified in one job
+RANDOM_SELF_TEST_BATCH_SIZE = 256
+
+
+def _DoRandomSelfTest(executor, numJobs):
+    """Verify random test cases. Cases are generated on the fly and verified in batches, so the
+    number of cases is not limited by memory. Only summary is printed for each command.
+    """
+    for cmd in commands16.values():
+        numSkipped = 0
+        numPassed = 0
+        seenOpcodes = set()
+
+        def Batches():
+            nonlocal numSkipped
+            batch = []
+            for bindings in cmd.GenerateRandomTestCases(args.randomTests, args.randomSeed):
+                opc = cmd.GenerateOpcodeInt(bindings)
+                if opc in seenOpcodes:
+                    continue
+                seenOpcodes.add(opc)
+                tc = SelfTestCase(cmd, bindings)
+                if not _IsAssemblerTestable(tc):
+                    numSkipped += 1
+                    continue
+                batch.append(tc)
+                if len(batch) == RANDOM_SELF_TEST_BATCH_SIZE:
+                    yield batch
+                    batch = []
+            if len(batch) > 0:
+                yield batch
+
+        # Limited number of batches in flight
+        pending = deque()
+        for batch in itertools.chain(Batches(), (None,)):
+            if batch is not None:
+                pending.append((executor.submit(_SelfTestChunk, batch), len(batch)))
+            while len(pending) > 0 and (batch is None or len(pending) > numJobs * 2):
+                future, size = pending.popleft()
+                log, error = future.result()
+                if error is not None:
+                    # Log of the failed case only
+                    idx = max((i for i, line in enumerate(log) if line.startswith(f"[{cmd}]")),
+                              default=0)
+                    for line in log[idx:]:
+                        print(line)
+                    raise error
+                numPassed += size
+
+        print(f"[{cmd}] {numPassed} random cases passed, {numSkipped} skipped as not verifiable " +
+              f"by assembler, {args.randomTests - numPassed - numSkipped} duplicated")
+
+
+def DoSelfTest():
+    global asmCache
+
+    if args.asmOracle is None:
+        args.asmOracle = "builtin" if args.compiler is None else "toolchain"
+    if args.asmOracle != "builtin" and (args.compiler is None or args.objdump is None):
+        raise Exception("Compiler and objdump paths are required for toolchain self-testing")
+
+    if not args.noAsmCache and args.asmOracle != "builtin":
+        asmCache = AsmCache(args.asmCachePath or GetDefaultAsmCachePath(), args.asmCacheSize)
+
+    # List of test cases lists, one per command
+    cmdTestCases = []
+    for cmd in commands16.values():
+        cmdTestCases.append([SelfTestCase(cmd, tc) for tc in cmd.GenerateTestCases()])
+
+    # Split commands evenly between jobs, keeping original order
+    numJobs = max(1, min(args.jobs, len(cmdTestCases)))
+    chunks = []
+    for jobIdx in range(numJobs):
+        chunk = []
+        for testCases in cmdTestCases[jobIdx * len(cmdTestCases) // numJobs:
+                                      (jobIdx + 1) * len(cmdTestCases) // numJobs]:
+            chunk.extend(testCases)
+        chunks.append(chunk)
+
+    try:
+        with ThreadPoolExecutor(max_workers=numJobs) as executor:
+            # Results are collected in chunks order, so the output does not depend on scheduling
+            for log, error in executor.map(_SelfTestChunk, chunks):
+                for line in log:
+                    print(line)
+                if error is not None:
+                    raise error
+
+            if args.randomTests > 0:
+                print("\n========================= Random test cases =========================")
+                _DoRandomSelfTest(executor, numJobs)
+    finally:
+        # Assembled opcodes are valid even if verification failed
+        if asmCache is not None:
+            asmCache.Save()
 
     print("Self-testing successfully completed")
 
@@ -995,15 +2113,126 @@ class SelectionTree:
                 return f"{varName}[{self.hiBit}]"
             return f"{varName}[{self.hiBit}:{self.loBit}] != {self.notEqualValue}"
 
+        def Test(self, opcode16):
+            """
+            :param opcode16: 16-bits opcode (integer).
+            :return: True if the condition is satisfied (`first` branch is taken).
+            """
+            if self.loBit == self.hiBit:
+                return (opcode16 >> self.hiBit) & 1 != 0
+            mask = (1 << (self.hiBit - self.loBit + 1)) - 1
+            return (opcode16 >> self.loBit) & mask != self.notEqualValue
+
     def __init__(self, rootNode) -> None:
         self.rootNode = rootNode
+        # Leaf commands in tree order, ClassifyMany() returns indices in this list
+        self.commands = []
+        # Flattened tree for ClassifyMany(), created on first use
+        self._flatTree = None
+
+        def CollectCommands(node):
+            if isinstance(node, CommandDesc):
+                if node not in self.commands:
+                    self.commands.append(node)
+                return
+            CollectCommands(node.first)
+            CollectCommands(node.second)
+        # Root is None for empty commands table, or a command for single command table
+        if rootNode is not None:
+            CollectCommands(rootNode)
 
     @staticmethod
     def Generate(commands):
-        return SelectionTree(SelectionTree.GenerateNode(commands))
+        return SelectionTree(SelectionTree.GenerateNode(list(commands)))
+
+    def Classify(self, opcode16):
+        """
+        :param opcode16: 16-bits opcode (integer).
+        :return: Matched CommandDesc, None if the encoding is not supported.
+        """
+        node = self.rootNode
+        if node is None:
+            return None
+        while not isinstance(node, CommandDesc):
+            node = node.first if node.Test(opcode16) else node.second
+        return node if node.Matches(opcode16) else None
+
+    def _FlattenTree(self):
+        """Build NumPy arrays describing nodes, indexed by node index. Child references are node
+        indices, or -1 - (command index) for leaves.
+        """
+        nodes = []
+        def Collect(node):
+            nodes.append(node)
+            for child in (node.first, node.second):
+                if not isinstance(child, CommandDesc):
+                    Collect(child)
+        if isinstance(self.rootNode, SelectionTree.Node):
+            Collect(self.rootNode)
+        nodeIndices = {id(node): idx for idx, node in enumerate(nodes)}
+
+        def ChildRef(child):
+            if isinstance(child, CommandDesc):
+                return -1 - self.commands.index(child)
+            return nodeIndices[id(child)]
+
+        shift = np.array([node.loBit for node in nodes], dtype=np.int64)
+        mask = np.array([(1 << (node.hiBit - node.loBit + 1)) - 1 for node in nodes],
+                        dtype=np.int64)
+        # Single bit is tested for not being equal to zero
+        notEqual = np.array([0 if node.notEqualValue is None else node.notEqualValue
+                             for node in nodes], dtype=np.int64)
+        first = np.array([ChildRef(node.first) for node in nodes], dtype=np.int64)
+        second = np.array([ChildRef(node.second) for node in nodes], dtype=np.int64)
+        self._flatTree = (shift, mask, notEqual, first, second)
+
+    def ClassifyMany(self, opcodes16):
+        """Classify array of opcodes. All opcodes on the same tree level are evaluated at once.
+        :param opcodes16: NumPy integer array of 16-bits opcodes.
+        :return: NumPy int32 array of indices in `commands` list, -1 for unsupported encodings.
+        """
+        if np is None:
+            raise Exception("NumPy is required for batched classification")
+        if self._flatTree is None:
+            self._FlattenTree()
+        shift, mask, notEqual, first, second = self._flatTree
+
+        opcodes16 = np.asarray(opcodes16).astype(np.int64)
+        if self.rootNode is None:
+            return np.full(opcodes16.shape, -1, dtype=np.int32)
+        if isinstance(self.rootNode, CommandDesc):
+            state = np.full(opcodes16.shape, -1, dtype=np.int64)
+        else:
+            state = np.zeros(opcodes16.shape, dtype=np.int64)
+        active = np.flatnonzero(state >= 0)
+        while len(active) > 0:
+            nodeIdx = state[active]
+            ops = opcodes16[active]
+            cond = ((ops >> shift[nodeIdx]) & mask[nodeIdx]) != notEqual[nodeIdx]
+            state[active] = np.where(cond, first[nodeIdx], second[nodeIdx])
+            active = active[state[active] >= 0]
+
+        result = (-1 - state).astype(np.int32)
+        # Reject encodings which do not match the selected command
+        constantMask = np.array([cmd.constantMask for cmd in self.commands], dtype=np.int64)
+        constantValue = np.array([cmd.constantValue for cmd in self.commands], dtype=np.int64)
+        matched = (opcodes16 & constantMask[result]) == constantValue[result]
+        for cmdIdx, cmd in enumerate(self.commands):
+            for c in cmd.GetConstrainedRegisterFields():
+                loPos = c.position - c.GetSize() + 1
+                matched &= ~((result == cmdIdx) &
+                             (((opcodes16 >> loPos) & ((1 << c.GetSize()) - 1)) == c.isNotEqual))
+        result[~matched] = -1
+        return result
 
     @staticmethod
     def GenerateNode(commands):
+        """
+        :param commands: List of commands to select from.
+        :return: Root node, the command itself for single command, None for empty list.
+        """
+        if len(commands) == 0:
+            return None
         if len(commands) == 1:
             return commands[0]
         # List of possible nodes, one be selected with the best balance
@@ -1067,35 +2296,25 @@ class SelectionTree:
                     nzCommands.append(cmd)
         else:
             # Bit-field test against not-equal value.
-            # Bit index to value
-            value = {}
+            fieldMask = ((1 << (hiBit - loBit + 1)) - 1) << loBit
+            fieldValue = None
             for cmd in commands:
-                isConstant = None
-                for bitIdx in range(loBit, hiBit + 1):
-                    bit = cmd.GetConstantBit(bitIdx)
-                    if bit is None:
-                        if isConstant is None:
-                            isConstant = False
-                        elif isConstant:
-                            return None
-                    else:
-                        if isConstant is None:
-                            isConstant = True
-                        elif not isConstant:
-                            return None
-                        if bitIdx in value:
-                            if value[bitIdx] != bit:
-                                return None
-                        else:
-                            value[bitIdx] = bit
-                if isConstant:
+                constantBits = cmd.constantMask & fieldMask
+                if constantBits == fieldMask:
+                    value = cmd.constantValue & fieldMask
+                    if fieldValue is not None and fieldValue != value:
+                        return None
+                    fieldValue = value
                     zCommands.append(cmd)
-                else:
+                elif constantBits == 0:
                     nzCommands.append(cmd)
-            notEqualValue = 0
-            for bitIdx in range(loBit, hiBit + 1):
-                if value[bitIdx]:
-                    notEqualValue = notEqualValue | (1 << (bitIdx - loBit))
+                else:
+                    # Partially constant field
+                    return None
+            if len(zCommands) == 0:
+                # No command with constant value in the field
+                return None
+            notEqualValue = fieldValue >> loBit
             # Check if all nzCommands have constrained field in target bits
             for cmd in nzCommands:
                 field = cmd.GetField(hiBit)
@@ -1114,88 +2333,2043 @@ class SelectionTree:
         node.second = zCommands
         return node
 
-    def GenerateVerilog(self, insn16VarName, insn32VarName):
+    @staticmethod
+    def GetCandidateSplits(commands):
+        """
+        :return: List of tuples (hiBit, loBit) with all bits and bit-fields the commands can be
+        split on. loBit is None for single bit test.
+        """
+        splits = [(i, None) for i in range(16)]
+        for cmd in commands:
+            for field in cmd.GetConstrainedRegisterFields():
+                split = (field.position, field.position - field.GetSize() + 1)
+                if split not in splits:
+                    splits.append(split)
+        return splits
+
+    @staticmethod
+    def GenerateOptimal(commands, objective="depth", weights=None, timeBudget=None):
+        """Search for a tree with minimal depth or minimal weighted cost. Results are memoized by
+        the set of remaining commands. If the time budget is exhausted, the remaining subtrees are
+        generated by the greedy algorithm.
+        :param objective: "depth" to minimize maximal depth (weighted cost is used to break ties),
+        "cost" to minimize weighted cost (sum of leaf weights multiplied by leaf depth).
+        :param weights: Dictionary with weight by command name, 1 for missing commands.
+        :param timeBudget: Time limit for the search in seconds, None for no limit.
+        :return: Tuple (SelectionTree, True if the search was completed within the time budget).
+        """
+        if objective not in ("depth", "cost"):
+            raise Exception(f"Unknown objective: {objective}")
+        search = SelectionTree._OptimalSearch(list(commands), objective, weights, timeBudget)
+        rootNode = search.Build(search.commands)
+        return SelectionTree(rootNode), not search.isTimedOut
+
+    class _OptimalSearch:
+        def __init__(self, commands, objective, weights, timeBudget) -> None:
+            self.commands = commands
+            self.objective = objective
+            self.weights = {cmd: 1 if weights is None else weights.get(cmd.name, 1)
+                            for cmd in commands}
+            self.deadline = None if timeBudget is None else time.monotonic() + timeBudget
+            self.isTimedOut = False
+            self.order = {cmd: idx for idx, cmd in enumerate(commands)}
+            self.splits = SelectionTree.GetCandidateSplits(commands)
+            # Frozen set of commands to tuple (score, split or ready greedy subtree). Score is tuple
+            # (depth, cost) or (cost, depth) depending on objective, compared lexicographically.
+            self.memo = {}
+
+        def _Score(self, depth, cost):
+            return (depth, cost) if self.objective == "depth" else (cost, depth)
+
+        def _Unscore(self, score):
+            """
+            :return: Tuple (depth, cost).
+            """
+            return score if self.objective == "depth" else (score[1], score[0])
+
+        def Search(self, commands):
+            """
+            :param commands: List of commands in original order.
+            :return: Score for the best tree found for the commands.
+            """
+            if len(commands) <= 1:
+                return self._Score(0, 0)
+            key = frozenset(commands)
+            entry = self.memo.get(key)
+            if entry is not None:
+                return entry[0]
+
+            if self.deadline is not None and time.monotonic() > self.deadline:
+                self.isTimedOut = True
+                subtree = SelectionTree.GenerateNode(commands)
+                score = self._Score(SelectionTree.GetNodeDepth(subtree),
+                                    SelectionTree.GetNodeCost(subtree, self.weights))
+                self.memo[key] = (score, subtree)
+                return score
+
+            weight = sum(self.weights[cmd] for cmd in commands)
+            # Depth cannot be less than for balanced tree
+            minDepth = (len(commands) - 1).bit_length()
+            best = None
+            for hiBit, loBit in self.splits:
+                node = SelectionTree.TryGenerateNode(commands, hiBit, loBit)
+                if node is None:
+                    continue
+                depth1, cost1 = self._Unscore(self.Search(node.first))
+                depth2, cost2 = self._Unscore(self.Search(node.second))
+                score = self._Score(1 + max(depth1, depth2), weight + cost1 + cost2)
+                if best is None or score < best[0]:
+                    best = (score, (hiBit, loBit))
+                if self.objective == "depth" and best[0][0] == minDepth and \
+                    best[0][1] == weight * minDepth:
+                    # Perfectly balanced, cannot be improved
+                    break
+            if best is None:
+                raise Exception("Failed to generate selector for nodes: " +
+                                ", ".join(map(str, commands)))
+            self.memo[key] = best
+            return best[0]
+
+        def Build(self, commands):
+            """
+            :return: Root node of the best found tree for the commands.
+            """
+            self.Search(commands)
+            if len(commands) <= 1:
+                return commands[0] if len(commands) == 1 else None
+            _, split = self.memo[frozenset(commands)]
+            if not isinstance(split, tuple):
+                # Greedy subtree
+                return split
+            node = SelectionTree.TryGenerateNode(commands, *split)
+            node.first = self.Build(node.first)
+            node.second = self.Build(node.second)
+            return node
+
+    @staticmethod
+    def GetNodeDepth(node):
+        """
+        :return: Maximal number of conditions tested on a path from the node to a leaf.
+        """
+        if node is None or isinstance(node, CommandDesc):
+            return 0
+        return 1 + max(SelectionTree.GetNodeDepth(node.first),
+                       SelectionTree.GetNodeDepth(node.second))
+
+    @staticmethod
+    def GetNodeCost(node, weights=None, depth=0):
+        """
+        :param weights: Dictionary with weight by command or command name, 1 for missing commands.
+        :return: Weighted cost: sum of leaf weights multiplied by leaf depths.
+        """
+        if node is None:
+            return 0
+        if isinstance(node, CommandDesc):
+            if weights is None:
+                return depth
+            return depth * weights.get(node, weights.get(node.name, 1))
+        return (SelectionTree.GetNodeCost(node.first, weights, depth + 1) +
+                SelectionTree.GetNodeCost(node.second, weights, depth + 1))
+
+    def GetDepth(self):
+        return SelectionTree.GetNodeDepth(self.rootNode)
+
+    def GetCost(self, weights=None):
+        return SelectionTree.GetNodeCost(self.rootNode, weights)
+
+    def GenerateVerilog(self, insn16VarName, insn32VarName, sharing=None):
         """
         :param insn16VarName: Name for input variable which stores 16-bits opcode.
         :param insn32VarName: Name for output variable which stores 32-bits opcode.
+        :param sharing: Optional TransformSharing for the tree, leaf expressions use its shared
+        wires and merged subtrees.
         :return: String with Verilog code for decompressing 16-bits instruction.
         """
-        return self._GenerateNodeVerilog(self.rootNode, insn16VarName, insn32VarName, 0)
+        def GenerateLeaf(cmd, indent):
+            if sharing is None:
+                expr = GetCommandTransform(cmd).GenerateVerilogExpression(insn16VarName)
+            else:
+                expr = sharing.GetExpression(cmd)
+            return (f"{indent}// {cmd} -> {cmd.mapTo.targetCmd}\n" +
+                    f"{indent}{insn32VarName} = {expr};\n")
+
+        def GenerateMergedNode(node, indent):
+            group = sharing.GetMergeGroup(node)
+            if group is None:
+                return None
+
+            def GenerateMergedLeaf(cmd, indent):
+                return (f"{indent}// {cmd}\n" +
+                        f"{indent}{group.varName} = {group.GetBitsLiteral(cmd)};\n")
+
+            _indent = "    " * indent
+            s = f"{_indent}// {', '.join(map(str, group.commands))} -> " + \
+                f"{', '.join(group.GetTargetNames())}\n"
+            if len(group.bits) > 0:
+                s += self._GenerateNodeVerilog(node, insn16VarName, GenerateMergedLeaf, indent)
+            s += f"{_indent}{insn32VarName} = {sharing.GetGroupExpression(group)};\n"
+            return s
+
+        if not isinstance(self.rootNode, SelectionTree.Node):
+            return self._GenerateRootLeafVerilog(insn32VarName, GenerateLeaf)
+        nodeGenerator = None if sharing is None else GenerateMergedNode
+        if nodeGenerator is not None:
+            s = nodeGenerator(self.rootNode, 0)
+            if s is not None:
+                return s
+        return self._GenerateNodeVerilog(self.rootNode, insn16VarName, GenerateLeaf, 0,
+                                         nodeGenerator)
+
+    def GenerateSelectVerilog(self, insn16VarName, selVarName, cmdIndices):
+        """
+        :param insn16VarName: Name for input variable which stores 16-bits opcode.
+        :param selVarName: Name for output variable which receives the selected command index.
+        :param cmdIndices: Dictionary with index value for each command.
+        :return: String with Verilog code for selecting command without its transformation.
+        """
+        width = GetIndexWidth(len(cmdIndices))
 
-    def _GenerateNodeVerilog(self, node, insn16VarName, insn32VarName, indent):
+        def GenerateLeaf(cmd, indent):
+            return f"{indent}// {cmd}\n{indent}{selVarName} = {width}'d{cmdIndices[cmd]};\n"
+
+        if not isinstance(self.rootNode, SelectionTree.Node):
+            return self._GenerateRootLeafVerilog(selVarName, GenerateLeaf)
+        return self._GenerateNodeVerilog(self.rootNode, insn16VarName, GenerateLeaf, 0)
+
+    def _GenerateRootLeafVerilog(self, outVarName, leafGenerator):
+        """
+        :return: Code for the tree without selection nodes: single command, or no commands at all.
+        """
+        if self.rootNode is None:
+            return f"// No compressed commands supported\n{outVarName} = 'x;\n"
+        return leafGenerator(self.rootNode, "")
+
+    def _GenerateNodeVerilog(self, node, insn16VarName, leafGenerator, indent, nodeGenerator=None):
+        """
+        :param leafGenerator: Function (command, indentation string) which returns leaf code.
+        :param nodeGenerator: Optional function (node, indentation level) which returns code for
+        the whole subtree, or None to generate it as usual.
+        """
         INDENT = "    "
         _indent = INDENT * indent
+
+        def GenerateChild(child):
+            if isinstance(child, CommandDesc):
+                return leafGenerator(child, _indent + INDENT)
+            if nodeGenerator is not None:
+                s = nodeGenerator(child, indent + 1)
+                if s is not None:
+                    return s
+            return self._GenerateNodeVerilog(child, insn16VarName, leafGenerator, indent + 1,
+                                             nodeGenerator)
+
         s = ""
         s += f"{_indent}if ({node.GetConditionExpr(insn16VarName)}) begin\n"
-        if isinstance(node.first, CommandDesc):
-            s += f"{_indent + INDENT}// {node.first} -> {node.first.mapTo.targetCmd}\n"
-            t = CommandTransform(node.first)
-            s += f"{_indent + INDENT}{insn32VarName} = {t.GenerateVerilogExpression(insn16VarName)};\n"
-        else:
-            s += self._GenerateNodeVerilog(node.first, insn16VarName, insn32VarName, indent + 1)
+        s += GenerateChild(node.first)
         s += f"{_indent}end else begin\n"
-        if isinstance(node.second, CommandDesc):
-            s += f"{_indent + INDENT}// {node.second} -> {node.second.mapTo.targetCmd}\n"
-            t = CommandTransform(node.second)
-            s += f"{_indent + INDENT}{insn32VarName} = {t.GenerateVerilogExpression(insn16VarName)};\n"
-        else:
-            s += self._GenerateNodeVerilog(node.second, insn16VarName, insn32VarName, indent + 1)
+        s += GenerateChild(node.second)
         s += f"{_indent}end\n"
         return s
 
 
+class CasezDecompressor:
+    """Flat decompressor implementation: one `unique casez` over the 16-bits opcode with a case
+    item per command, so that synthesis gets parallel structure instead of priority chain.
+    """
+    def __init__(self, commands) -> None:
+        self.commands = list(commands)
+        # Tuples (command, list of (mask, value) patterns)
+        self.items = [(cmd, CasezDecompressor.GetPatterns(cmd)) for cmd in self.commands]
+        self._CheckDisjoint()
+
+    @staticmethod
+    def GetPatterns(cmd):
+        """
+        :return: List of disjoint (mask, value) patterns which together match exactly the command
+        encodings. Constant bits give one pattern, each not-equal constrained field splits it into
+        one pattern per field bit: higher bits equal to the disallowed value, the bit differs, lower
+        bits are arbitrary.
+        """
+        patterns = [(cmd.constantMask, cmd.constantValue)]
+        for c in cmd.GetConstrainedRegisterFields():
+            loPos = c.position - c.GetSize() + 1
+            newPatterns = []
+            for mask, value in patterns:
+                for bitIdx in range(c.GetSize() - 1, -1, -1):
+                    fieldMask = ((1 << c.GetSize()) - 1) & ~((1 << bitIdx) - 1)
+                    fieldValue = (c.isNotEqual ^ (1 << bitIdx)) & fieldMask
+                    newPatterns.append((mask | (fieldMask << loPos), value | (fieldValue << loPos)))
+            patterns = newPatterns
+        return patterns
+
+    @staticmethod
+    def FormatPattern(mask, value):
+        s = ""
+        for bitIdx in range(15, -1, -1):
+            if mask & (1 << bitIdx) == 0:
+                s += "?"
+            else:
+                s += "1" if value & (1 << bitIdx) != 0 else "0"
+            if bitIdx % 4 == 0 and bitIdx != 0:
+                s += "_"
+        return f"16'b{s}"
+
+    def _CheckDisjoint(self):
+        patterns = [(cmd, p) for cmd, cmdPatterns in self.items for p in cmdPatterns]
+        for i, (cmd1, (mask1, value1)) in enumerate(patterns):
+            for cmd2, (mask2, value2) in patterns[i + 1:]:
+                if (value1 ^ value2) & mask1 & mask2 == 0:
+                    raise Exception(f"Overlapping case items for {cmd1} and {cmd2}")
+
+    def GenerateVerilog(self, insn16VarName, insn32VarName, sharing=None):
+        """
+        :param insn16VarName: Name for input variable which stores 16-bits opcode.
+        :param insn32VarName: Name for output variable which stores 32-bits opcode.
+        :param sharing: Optional TransformSharing, case item expressions use its shared wires.
+        :return: String with Verilog code for decompressing 16-bits instruction.
+        """
+        INDENT = "    "
+        s = f"unique casez ({insn16VarName})\n"
+        for cmd, patterns in self.items:
+            if sharing is None:
+                expr = GetCommandTransform(cmd).GenerateVerilogExpression(insn16VarName)
+            else:
+                expr = sharing.GetExpression(cmd)
+            s += f"{INDENT}// {cmd} -> {cmd.mapTo.targetCmd}\n"
+            s += ",\n".join(INDENT + CasezDecompressor.FormatPattern(*p) for p in patterns) + ":\n"
+            s += f"{INDENT * 2}{insn32VarName} = {expr};\n"
+        s += f"{INDENT}default:\n"
+        s += f"{INDENT * 2}// Unsupported encoding\n"
+        s += f"{INDENT * 2}{insn32VarName} = 'x;\n"
+        s += "endcase\n"
+        return s
+
+    def GenerateSelectVerilog(self, insn16VarName, selVarName, cmdIndices):
+        """
+        :param insn16VarName: Name for input variable which stores 16-bits opcode.
+        :param selVarName: Name for output variable which receives the selected command index.
+        :param cmdIndices: Dictionary with index value for each command.
+        :return: String with Verilog code for selecting command without its transformation.
+        """
+        INDENT = "    "
+        width = GetIndexWidth(len(cmdIndices))
+        s = f"unique casez ({insn16VarName})\n"
+        for cmd, patterns in self.items:
+            s += f"{INDENT}// {cmd}\n"
+            s += ",\n".join(INDENT + CasezDecompressor.FormatPattern(*p) for p in patterns) + ":\n"
+            s += f"{INDENT * 2}{selVarName} = {width}'d{cmdIndices[cmd]};\n"
+        s += f"{INDENT}default:\n"
+        s += f"{INDENT * 2}{selVarName} = 'x;\n"
+        s += "endcase\n"
+        return s
+
+
+class SopDecompressor:
+    """Two-level logic implementation: each output bit is a minimized sum of products of the opcode
+    bits, emitted as a separate `assign`. The bit truth function is derived from the commands table
+    as ON and OFF sets of cubes, all unsupported encodings are don't-cares. Minimization is
+    espresso-like: each ON-set cube is expanded into prime implicants against the OFF-set, then a
+    minimal cover is selected from the prime implicants chart as in Quine-McCluskey method.
+    """
+    def __init__(self, commands) -> None:
+        self.commands = list(commands)
+        # Output bit to list of (mask, value) product terms
+        self.outputs = {}
+        for bit in CostReport.OUTPUT_BITS:
+            onSet, offSet = self.GetOnOffSets(bit)
+            self.outputs[bit] = SopDecompressor.Minimize(onSet, offSet)
+
+    def GetOnOffSets(self, bit):
+        """
+        :return: Tuple (ON-set, OFF-set) of the output bit, each is a list of (mask, value) cubes
+        over the 16-bits opcode.
+        """
+        onSet = []
+        offSet = []
+        for cmd in self.commands:
+            kind, value = GetCommandTransform(cmd).GetBitSources()[bit]
+            for mask, patValue in CasezDecompressor.GetPatterns(cmd):
+                if kind == "const":
+                    (onSet if value else offSet).append((mask, patValue))
+                elif mask & (1 << value) != 0:
+                    # Source bit is constant in the pattern
+                    (onSet if patValue & (1 << value) else offSet).append((mask, patValue))
+                else:
+                    onSet.append((mask | (1 << value), patValue | (1 << value)))
+                    offSet.append((mask | (1 << value), patValue))
+        return onSet, offSet
+
+    @staticmethod
+    def Contains(cube, subCube):
+        """
+        :return: True if all the subCube minterms are in the cube.
+        """
+        mask, value = cube
+        subMask, subValue = subCube
+        return mask & ~subMask == 0 and (value ^ subValue) & mask == 0
+
+    @staticmethod
+    def Expand(cube, offSet, bitsOrder):
+        """Remove literals from the cube in the specified order while it does not intersect the
+        OFF-set.
+        :return: Prime implicant containing the cube.
+        """
+        mask, value = cube
+        for bitIdx in bitsOrder:
+            if mask & (1 << bitIdx) == 0:
+                continue
+            newMask = mask & ~(1 << bitIdx)
+            if all((value ^ offValue) & newMask & offMask != 0 for offMask, offValue in offSet):
+                mask = newMask
+                value &= newMask
+        return mask, value
+
+    @staticmethod
+    def Minimize(onSet, offSet):
+        """
+        :return: List of (mask, value) product terms covering the ON-set and not intersecting the
+        OFF-set. Empty list for constant zero, one term with zero mask for constant one.
+        """
+        if len(onSet) == 0:
+            return []
+        if len(offSet) == 0:
+            return [(0, 0)]
+
+        # Literals which are rarely needed to separate from the OFF-set are removed first
+        literalUses = [sum(1 for offMask, _ in offSet if offMask & (1 << bitIdx) != 0)
+                       for bitIdx in range(16)]
+        orders = (range(15, -1, -1), range(16),
+                  sorted(range(16), key=lambda bitIdx: (literalUses[bitIdx], bitIdx)))
+        primes = []
+        for cube in onSet:
+            for order in orders:
+                prime = SopDecompressor.Expand(cube, offSet, order)
+                if prime not in primes:
+                    primes.append(prime)
+
+        # Prime implicants chart: ON-set cubes contained in each prime
+        covers = [set(idx for idx, cube in enumerate(onSet) if SopDecompressor.Contains(p, cube))
+                  for p in primes]
+        uncovered = set(range(len(onSet)))
+        selected = []
+        # Essential primes first
+        for idx in range(len(onSet)):
+            coveringPrimes = [pIdx for pIdx, cover in enumerate(covers) if idx in cover]
+            if len(coveringPrimes) == 1 and coveringPrimes[0] not in selected:
+                selected.append(coveringPrimes[0])
+                uncovered -= covers[coveringPrimes[0]]
+        # Then greedily the ones covering most, with fewer literals on tie
+        while len(uncovered) > 0:
+            pIdx = max(range(len(primes)),
+                       key=lambda pIdx: (len(covers[pIdx] & uncovered),
+                                         -bin(primes[pIdx][0]).count("1")))
+            selected.append(pIdx)
+            uncovered -= covers[pIdx]
+        # Remove redundant primes covered by the other selected ones
+        for pIdx in list(reversed(selected)):
+            rest = set().union(*(covers[i] for i in selected if i != pIdx))
+            if covers[pIdx] <= rest:
+                selected.remove(pIdx)
+        return sorted((primes[pIdx] for pIdx in selected), key=lambda p: (-p[0], p[1]))
+
+    def Evaluate(self, opcode16):
+        """
+        :param opcode16: 16-bits opcode (integer).
+        :return: 32-bits opcode (integer) produced by the minimized functions. The result is
+        meaningful for supported encodings only.
+        """
+        result = 3
+        for bit, terms in self.outputs.items():
+            if any((opcode16 ^ value) & mask == 0 for mask, value in terms):
+                result |= 1 << bit
+        return result
+
+    @staticmethod
+    def FormatTerm(term, varName):
+        mask, value = term
+        literals = []
+        for bitIdx in range(15, -1, -1):
+            if mask & (1 << bitIdx) != 0:
+                literals.append(f"{'' if value & (1 << bitIdx) else '~'}{varName}[{bitIdx}]")
+        return " & ".join(literals)
+
+    def GenerateVerilog(self, insn16VarName, insn32VarName):
+        """
+        :param insn16VarName: Name for input variable which stores 16-bits opcode.
+        :param insn32VarName: Name for output variable which stores 32-bits opcode.
+        :return: String with Verilog continuous assignments for decompressing 16-bits instruction.
+        """
+        s = ""
+        for bit, terms in self.outputs.items():
+            lhs = f"assign {insn32VarName}[{bit}] = "
+            if len(terms) == 0:
+                expr = "1'b0"
+            elif terms[0][0] == 0:
+                expr = "1'b1"
+            elif len(terms) == 1:
+                expr = SopDecompressor.FormatTerm(terms[0], insn16VarName)
+            else:
+                expr = f" |\n{' ' * len(lhs)}".join(
+                    f"({SopDecompressor.FormatTerm(t, insn16VarName)})" for t in terms)
+            s += f"{lhs}{expr};\n"
+        return s
+
+
+def GetIndexWidth(numValues):
+    """
+    :return: Number of bits for index in range [0; numValues).
+    """
+    return max(1, (numValues - 1).bit_length())
+
+
+def Indent(code, indent):
+    return "".join(indent + line if line.strip() else line for line in code.splitlines(True))
+
+
+def GenerateRegisteredDecompressorVerilog(decompressor, isShared=False):
+    """Generate implementation of the registered decompressor module with one cycle latency. The
+    first stage selects command, the selected command index is registered together with the opcode,
+    and the second stage reassembles fields of the selected command. Ports: `clock`, `enable`,
+    `insn16`, `insn32`.
+    :param decompressor: Selection tree or casez decompressor, used for the selection stage.
+    :param isShared: Use shared wires for common transform fields in the second stage.
+    :return: String with Verilog code for the module body.
+    """
+    if isinstance(decompressor, SopDecompressor):
+        raise Exception("Registered decompressor is not supported for sum of products style")
+    INDENT = "    "
+    cmdIndices = {cmd: idx for idx, cmd in enumerate(decompressor.commands)}
+    width = GetIndexWidth(len(cmdIndices))
+    s = "// Selection stage\n"
+    s += f"reg [{width - 1}:0] cmdSel;\n"
+    s += "always_comb begin\n"
+    s += Indent(decompressor.GenerateSelectVerilog("insn16", "cmdSel", cmdIndices), INDENT)
+    s += "end\n\n"
+
+    s += "// Stage register\n"
+    s += f"reg [{width - 1}:0] cmdIdx;\n"
+    s += "reg [15:0] insn16Reg;\n"
+    s += "always_ff @(posedge clock) begin\n"
+    s += f"{INDENT}if (enable) begin\n"
+    s += f"{INDENT * 2}cmdIdx <= cmdSel;\n"
+    s += f"{INDENT * 2}insn16Reg <= insn16;\n"
+    s += f"{INDENT}end\n"
+    s += "end\n\n"
+
+    sharing = TransformSharing(decompressor.commands, "insn16Reg") if isShared else None
+    if sharing is not None:
+        s += sharing.GenerateDeclarations()
+    s += "// Fields reassembly stage\n"
+    s += "always_comb begin\n"
+    s += f"{INDENT}unique case (cmdIdx)\n"
+    for cmd, idx in cmdIndices.items():
+        if sharing is None:
+            expr = GetCommandTransform(cmd).GenerateVerilogExpression("insn16Reg")
+        else:
+            expr = sharing.GetExpression(cmd)
+        s += f"{INDENT * 2}// {cmd} -> {cmd.mapTo.targetCmd}\n"
+        s += f"{INDENT * 2}{width}'d{idx}:\n"
+        s += f"{INDENT * 3}insn32 = {expr};\n"
+    s += f"{INDENT * 2}default:\n"
+    s += f"{INDENT * 3}insn32 = 'x;\n"
+    s += f"{INDENT}endcase\n"
+    s += "end\n"
+    return s
+
+
+class TransformSharing:
+    """Common subexpressions of command transforms. Transform fields (immediate layouts, register
+    fields expansion) are hash-consed by their output bit sources, and a field expression used by
+    several leaves is emitted once as a shared wire. When a selection tree is specified, its
+    subtrees whose commands differ only in a few constant output bits are merged into one
+    expression, and the differing bits are selected by a small multiplexer assigned in the subtree
+    leaves.
+    """
+    # Maximal number of differing constant bits for merging commands into one expression
+    MAX_MERGED_BITS = 4
+
+    class MergeGroup:
+        def __init__(self, varName, commands, bits) -> None:
+            # Multiplexer variable name, None if transforms are identical
+            self.varName = varName
+            self.commands = commands
+            # Differing output bits, high-ordered first
+            self.bits = bits
+
+        def GetBitsLiteral(self, cmd):
+            """
+            :return: Verilog literal with the command values of the differing bits.
+            """
+            sources = GetCommandTransform(cmd).GetBitSources()
+            return f"{len(self.bits)}'b" + "".join(str(sources[bit][1]) for bit in self.bits)
+
+        def GetTargetNames(self):
+            names = []
+            for cmd in self.commands:
+                if cmd.mapTo.targetCmd.name not in names:
+                    names.append(cmd.mapTo.targetCmd.name)
+            return names
+
+    def __init__(self, commands, insn16VarName, rootNode=None) -> None:
+        """
+        :param commands: Compressed commands to generate expressions for.
+        :param insn16VarName: Name for variable which stores 16-bits opcode.
+        :param rootNode: Selection tree root node to find merged subtrees in, if any.
+        """
+        self.insn16VarName = insn16VarName
+        self.groups = []
+        # Selection tree node to its merge group
+        self.nodeGroups = {}
+        if rootNode is not None:
+            self._FindMergeGroups(rootNode)
+        groupedCommands = set(cmd for group in self.groups for cmd in group.commands)
+
+        # Output bit tokens for each leaf expression (command or merge group), high-ordered first.
+        # Token is tuple ("const", value), ("bit", variable name, bit index) or ("wire", name).
+        self.leafTokens = {}
+        for cmd in commands:
+            if cmd not in groupedCommands:
+                self.leafTokens[cmd] = self._GetTokens(GetCommandTransform(cmd).GetBitSources())
+        for group in self.groups:
+            sources = list(GetCommandTransform(group.commands[0]).GetBitSources())
+            for idx, bit in enumerate(group.bits):
+                sources[bit] = ("var", len(group.bits) - 1 - idx)
+            self.leafTokens[group] = self._GetTokens(sources, group.varName)
+
+        # Hash-consed fields: key is tuple of field tokens, value is list of leaves using it
+        fieldUses = {}
+        fieldKinds = {}
+        for leaf, tokens in self.leafTokens.items():
+            cmd = leaf.commands[0] if isinstance(leaf, TransformSharing.MergeGroup) else leaf
+            for kind, hiBit, loBit in TransformSharing._GetFields(cmd.mapTo.targetCmd):
+                key = tuple(tokens[31 - hiBit:32 - loBit])
+                if not self._IsShareable(key):
+                    continue
+                uses = fieldUses.setdefault(key, [])
+                if leaf not in uses:
+                    uses.append(leaf)
+                fieldKinds.setdefault(key, kind)
+
+        # Shared wires in first use order: list of tuples (name, key)
+        self.wires = []
+        wireNames = {}
+        kindCounters = {}
+        for key, uses in fieldUses.items():
+            if len(uses) < 2:
+                continue
+            kind = fieldKinds[key]
+            name = f"{kind}Expr{kindCounters.get(kind, 0)}"
+            kindCounters[kind] = kindCounters.get(kind, 0) + 1
+            self.wires.append((name, key))
+            wireNames[key] = name
+
+        # Replace shared fields in leaf expressions
+        for leaf, tokens in self.leafTokens.items():
+            cmd = leaf.commands[0] if isinstance(leaf, TransformSharing.MergeGroup) else leaf
+            for _, hiBit, loBit in TransformSharing._GetFields(cmd.mapTo.targetCmd):
+                name = wireNames.get(tuple(tokens[31 - hiBit:32 - loBit]))
+                if name is not None:
+                    tokens[31 - hiBit:32 - loBit] = [("wire", name)] + \
+                        [None] * (hiBit - loBit)
+
+    @staticmethod
+    def GetDifferingBits(commands):
+        """
+        :return: List of output bits (high-ordered first) where the command transforms differ, None
+        if some of them is not constant.
+        """
+        sources = [GetCommandTransform(cmd).GetBitSources() for cmd in commands]
+        bits = []
+        for bit in CostReport.OUTPUT_BITS:
+            values = set(s[bit] for s in sources)
+            if len(values) == 1:
+                continue
+            if any(v[0] != "const" for v in values):
+                return None
+            bits.append(bit)
+        return bits
+
+    def _FindMergeGroups(self, node):
+        if isinstance(node, CommandDesc):
+            return
+        commands = []
+        def CollectCommands(node):
+            if isinstance(node, CommandDesc):
+                if node not in commands:
+                    commands.append(node)
+                return
+            CollectCommands(node.first)
+            CollectCommands(node.second)
+        CollectCommands(node)
+
+        bits = TransformSharing.GetDifferingBits(commands)
+        if bits is not None and len(bits) <= TransformSharing.MAX_MERGED_BITS:
+            varName = f"mergedBits{len(self.groups)}" if len(bits) > 0 else None
+            group = TransformSharing.MergeGroup(varName, commands, bits)
+            self.nodeGroups[node] = group
+            self.groups.append(group)
+            return
+        self._FindMergeGroups(node.first)
+        self._FindMergeGroups(node.second)
+
+    @staticmethod
+    def _GetFields(targetCmd):
+        """
+        :return: List of tuples (kind, hiBit, loBit) for target command fields which are sharing
+        candidates. Adjacent immediate chunks form one field, two LSB are not included.
+        """
+        fields = []
+        for c in targetCmd.components:
+            hiBit = c.position
+            loBit = c.position - c.GetSize() + 1
+            if isinstance(c, ImmediateBits):
+                if len(fields) > 0 and fields[-1][0] == "imm" and fields[-1][2] == hiBit + 1:
+                    fields[-1] = ("imm", fields[-1][1], loBit)
+                else:
+                    fields.append(("imm", hiBit, loBit))
+            elif isinstance(c, RegReference):
+                fields.append(("reg", hiBit, loBit))
+        return [(kind, hiBit, max(loBit, 2)) for kind, hiBit, loBit in fields if hiBit >= 2]
+
+    def _GetTokens(self, sources, varName=None):
+        """
+        :param sources: Output bit sources indexed by bit, as returned by
+        CommandTransform.GetBitSources(), or ("var", bit index) for multiplexer variable bits.
+        :return: Tokens list for output bits 31 to 2.
+        """
+        tokens = []
+        for bit in CostReport.OUTPUT_BITS:
+            kind, value = sources[bit]
+            if kind == "const":
+                tokens.append(("const", value))
+            elif kind == "in":
+                tokens.append(("bit", self.insn16VarName, value))
+            else:
+                tokens.append(("bit", varName, value))
+        return tokens
+
+    def _IsShareable(self, tokens):
+        """
+        :return: True if the field worth a shared wire: it depends on opcode bits and is not a
+        plain opcode bits slice.
+        """
+        if not any(t[0] == "bit" and t[1] == self.insn16VarName for t in tokens):
+            return False
+        if any(t[0] == "bit" and t[1] != self.insn16VarName for t in tokens):
+            return False
+        return len(TransformSharing._RenderPieces(tokens)) > 1
+
+    @staticmethod
+    def _RenderPieces(tokens):
+        """
+        :return: List of Verilog concatenation items for the tokens list.
+        """
+        pieces = []
+        i = 0
+        while i < len(tokens):
+            t = tokens[i]
+            j = i + 1
+            if t is None:
+                i = j
+                continue
+            if t[0] == "wire":
+                pieces.append(t[1])
+            elif t[0] == "const":
+                while j < len(tokens) and tokens[j] is not None and tokens[j][0] == "const":
+                    j += 1
+                pieces.append(f"{j - i}'b" + "".join(str(tokens[k][1]) for k in range(i, j)))
+            else:
+                _, name, bitIdx = t
+                while j < len(tokens) and tokens[j] == t:
+                    j += 1
+                if j - i > 1:
+                    # Bit replication
+                    pieces.append(f"{{{j - i}{{{name}[{bitIdx}]}}}}")
+                else:
+                    while (j < len(tokens) and tokens[j] is not None and tokens[j][0] == "bit" and
+                           tokens[j][1] == name and tokens[j][2] == bitIdx - (j - i) and
+                           (j + 1 >= len(tokens) or tokens[j + 1] != tokens[j])):
+                        j += 1
+                    if j - i > 1:
+                        pieces.append(f"{name}[{bitIdx}:{bitIdx - (j - i) + 1}]")
+                    else:
+                        pieces.append(f"{name}[{bitIdx}]")
+            i = j
+        return pieces
+
+    @staticmethod
+    def _Render(tokens):
+        return "{" + ", ".join(TransformSharing._RenderPieces(tokens)) + "}"
+
+    def GetMergeGroup(self, node):
+        """
+        :return: MergeGroup for the selection tree node, None if the node is not merged.
+        """
+        return self.nodeGroups.get(node)
+
+    def GetExpression(self, cmd):
+        """
+        :return: Expression for decompressed 30 bits opcode of a command which is not merged.
+        """
+        return TransformSharing._Render(self.leafTokens[cmd])
+
+    def GetGroupExpression(self, group):
+        """
+        :return: Expression for decompressed 30 bits opcode of merged commands.
+        """
+        return TransformSharing._Render(self.leafTokens[group])
+
+    def GenerateDeclarations(self):
+        """
+        :return: Module level declarations of shared wires and merged bits multiplexer variables.
+        """
+        s = ""
+        if len(self.wires) > 0:
+            s += "// Shared transform fields\n"
+            for name, key in self.wires:
+                s += f"wire [{len(key) - 1}:0] {name} = {TransformSharing._Render(key)};\n"
+            s += "\n"
+        groups = [group for group in self.groups if group.varName is not None]
+        if len(groups) > 0:
+            s += "// Differing bits of merged commands\n"
+            for group in groups:
+                s += f"reg [{len(group.bits) - 1}:0] {group.varName};\n"
+            s += "\n"
+        return s
+
+    def GenerateDefaults(self):
+        """
+        :return: Assignments for the beginning of the combinational block, so that merged bits
+        variables are assigned on all paths.
+        """
+        return "".join(f"{group.varName} = 'x;\n" for group in self.groups
+                       if group.varName is not None)
+
+
+def EstimateLut4(numInputs):
+    """
+    :return: Tuple (LUT4 count, logic levels) for arbitrary function of the specified number of
+    inputs, assuming LUT4 tree decomposition.
+    """
+    if numInputs <= 1:
+        return 0, 0
+    count = 0
+    depth = 0
+    while numInputs > 1:
+        luts = (numInputs + 3) // 4
+        count += luts
+        depth += 1
+        numInputs = luts
+    return count, depth
+
+
+class CostReport:
+    """Structural cost estimation for generated decompressor. The numbers are not synthesis
+    results, but they are computed the same way for each backend, so variants can be compared.
+    """
+    # Decompressor output bits, two LSB are always set
+    OUTPUT_BITS = range(31, 1, -1)
+
+    def __init__(self, backend) -> None:
+        self.backend = backend
+        # Selection logic depth in decisions (tree depth, 1 for flat selection)
+        self.selectDepth = 0
+        # Number of multi-bit comparators (not-equal tests or pattern matches)
+        self.comparators = 0
+        # LUT4 count for comparators
+        self.comparatorLut4 = 0
+        # List of dictionaries, one per output bit
+        self.outputs = []
+
+    def AddOutput(self, bit, sources, lut4, depth, muxes):
+        """
+        :param sources: Set of distinct data sources for the bit (mux fan-in).
+        """
+        self.outputs.append({
+            "bit": bit,
+            "fanIn": len(sources),
+            "muxes": muxes,
+            "lut4": lut4,
+            "depth": depth
+        })
+
+    def GetLut4(self):
+        return self.comparatorLut4 + sum(o["lut4"] for o in self.outputs)
+
+    def GetLogicDepth(self):
+        return max((o["depth"] for o in self.outputs), default=0)
+
+    def ToJson(self):
+        return {
+            "backend": self.backend,
+            "selectDepth": self.selectDepth,
+            "comparators": self.comparators,
+            "comparatorLut4": self.comparatorLut4,
+            "lut4": self.GetLut4(),
+            "logicDepth": self.GetLogicDepth(),
+            "maxFanIn": max((o["fanIn"] for o in self.outputs), default=0),
+            "outputs": self.outputs
+        }
+
+    def GetSummary(self):
+        return (f"Decompressor cost ({self.backend}): select depth {self.selectDepth}, " +
+                f"{self.comparators} comparators, " +
+                f"max fan-in {max((o['fanIn'] for o in self.outputs), default=0)}, " +
+                f"~{self.GetLut4()} LUT4, logic depth ~{self.GetLogicDepth()}")
+
+
+def EstimateTreeCost(selTree):
+    """Model: each tree node is 2:1 multiplexer for each output bit, unless both branches produce
+    identical value (identical subtrees are shared). Multiplexer between two constants costs nothing
+    (select signal or its inverse), other ones take one LUT4 and one logic level. Not-equal tests
+    are comparators shared between all output bits.
+    """
+    report = CostReport("tree")
+    report.selectDepth = selTree.GetDepth()
+
+    # Collect distinct comparators
+    comparators = set()
+    def CollectComparators(node):
+        if node is None or isinstance(node, CommandDesc):
+            return
+        if node.hiBit != node.loBit:
+            comparators.add((node.hiBit, node.loBit, node.notEqualValue))
+        CollectComparators(node.first)
+        CollectComparators(node.second)
+    CollectComparators(selTree.rootNode)
+    report.comparators = len(comparators)
+    comparatorDepth = 0
+    for hiBit, loBit, _ in comparators:
+        lut4, depth = EstimateLut4(hiBit - loBit + 1)
+        report.comparatorLut4 += lut4
+        comparatorDepth = max(comparatorDepth, depth)
+
+    sources = {cmd: GetCommandTransform(cmd).GetBitSources() for cmd in selTree.commands}
+    for bit in CostReport.OUTPUT_BITS:
+        # Expression to (depth, uses comparator) for already evaluated shared subexpressions
+        evaluated = {}
+        def Eval(node):
+            """
+            :return: Tuple (expression, muxes count, logic depth, uses comparator).
+            """
+            if isinstance(node, CommandDesc):
+                return sources[node][bit], 0, 0, False
+            first = Eval(node.first)
+            second = Eval(node.second)
+            if first[0] == second[0]:
+                return first
+            expr = ("mux", node.hiBit, node.loBit, first[0], second[0])
+            if expr in evaluated:
+                # Shared subexpression, already counted
+                return (expr, 0) + evaluated[expr]
+            isConstMux = first[0][0] == "const" and second[0][0] == "const"
+            depth = max(first[2], second[2]) + (0 if isConstMux else 1)
+            usesComparator = first[3] or second[3] or node.hiBit != node.loBit
+            evaluated[expr] = (depth, usesComparator)
+            return expr, first[1] + second[1] + (0 if isConstMux else 1), depth, usesComparator
+
+        bitSources = set(sources[cmd][bit] for cmd in selTree.commands)
+        if selTree.rootNode is None:
+            # No commands, output is don't care
+            report.AddOutput(bit, bitSources, 0, 0, 0)
+            continue
+        _, muxes, depth, usesComparator = Eval(selTree.rootNode)
+        if usesComparator:
+            depth += comparatorDepth
+        report.AddOutput(bit, bitSources, muxes, depth, muxes)
+    return report
+
+
+def EstimateCasezCost(decompressor):
+    """Model: each case item is a pattern comparator on its constant bits, each output bit is OR
+    of (match & data) terms for the commands where the bit is not constant zero (unsupported
+    encodings are don't-care, so a bit which is the same for all commands needs no logic).
+    """
+    report = CostReport("casez")
+    report.selectDepth = 1
+    comparatorDepth = 0
+    for cmd, patterns in decompressor.items:
+        matchDepth = 0
+        for mask, _ in patterns:
+            report.comparators += 1
+            lut4, depth = EstimateLut4(bin(mask).count("1"))
+            report.comparatorLut4 += lut4
+            matchDepth = max(matchDepth, depth)
+        # Several patterns of one command are OR-ed
+        lut4, depth = EstimateLut4(len(patterns))
+        report.comparatorLut4 += lut4
+        comparatorDepth = max(comparatorDepth, matchDepth + depth)
+
+    sources = {cmd: GetCommandTransform(cmd).GetBitSources() for cmd in decompressor.commands}
+    for bit in CostReport.OUTPUT_BITS:
+        bitSources = set(sources[cmd][bit] for cmd in decompressor.commands)
+        if len(bitSources) == 1:
+            report.AddOutput(bit, bitSources, 0, 0, 0)
+            continue
+        # Match signal and data bit per term, constant one terms need match signal only
+        numInputs = 0
+        for cmd in decompressor.commands:
+            source = sources[cmd][bit]
+            if source == ("const", 0):
+                continue
+            numInputs += 1 if source[0] == "const" else 2
+        lut4, depth = EstimateLut4(numInputs)
+        report.AddOutput(bit, bitSources, lut4, comparatorDepth + depth, len(bitSources) - 1)
+    return report
+
+
+def EstimateSopCost(decompressor):
+    """Model: each distinct product term is AND of its literals, shared between all output bits
+    (counted as comparators), each output bit is OR of its terms. Single literal terms and single
+    term outputs need no logic.
+    """
+    report = CostReport("sop")
+    report.selectDepth = 1
+    termDepths = {}
+    for terms in decompressor.outputs.values():
+        for mask, value in terms:
+            if (mask, value) in termDepths:
+                continue
+            lut4, depth = EstimateLut4(bin(mask).count("1"))
+            termDepths[(mask, value)] = depth
+            if lut4 > 0:
+                report.comparators += 1
+                report.comparatorLut4 += lut4
+
+    for bit, terms in decompressor.outputs.items():
+        lut4, depth = EstimateLut4(len(terms))
+        depth += max((termDepths[t] for t in terms), default=0)
+        report.AddOutput(bit, set(terms), lut4, depth, 0)
+    return report
+
+
+def GenerateCostReport(decompressor, outputPath):
+    if isinstance(decompressor, SelectionTree):
+        report = EstimateTreeCost(decompressor)
+    elif isinstance(decompressor, CasezDecompressor):
+        report = EstimateCasezCost(decompressor)
+    elif isinstance(decompressor, SopDecompressor):
+        report = EstimateSopCost(decompressor)
+    else:
+        raise Exception(f"Unsupported decompressor type: {decompressor.__class__.__name__}")
+    print(report.GetSummary())
+    if not isinstance(decompressor, SelectionTree):
+        # Selection tree is the reference implementation to compare with
+        print(EstimateTreeCost(BuildSelectionTree()).GetSummary())
+    if outputPath is not None:
+        WriteOutput(outputPath, json.dumps(report.ToJson(), indent=4))
+    return report
+
+
+# Selection tree for commands16, created by BuildSelectionTree()
+selectionTree = None
+
+
+def BuildSelectionTree():
+    """Generate the selection tree for compressed commands using the algorithm selected by command
+    line arguments. The tree is created once and shared by all the outputs.
+    """
+    global selectionTree
+
+    if selectionTree is not None:
+        return selectionTree
+    with ProfilePhase("SelectionTree"):
+        greedyTree = SelectionTree.Generate(list(commands16.values()))
+        mode = "greedy" if args is None else args.decompTree
+        if mode == "greedy":
+            selectionTree = greedyTree
+            return selectionTree
+
+        weights = None
+        if args.treeWeights:
+            with open(args.treeWeights, "r") as f:
+                weights = json.load(f)
+        selectionTree, isComplete = SelectionTree.GenerateOptimal(
+            list(commands16.values()), "depth" if mode == "minDepth" else "cost", weights,
+            args.treeSearchTime)
+    print(f"Selection tree ({mode}{'' if isComplete else ', search time exceeded'}): " +
+          f"depth {selectionTree.GetDepth()}, cost {selectionTree.GetCost(weights)}; " +
+          f"greedy: depth {greedyTree.GetDepth()}, cost {greedyTree.GetCost(weights)}")
+    return selectionTree
+
+
+def BuildDecompressor():
+    """
+    :return: Decompressor implementation selected by command line arguments.
+    """
+    if args.decompStyle == "casez":
+        return CasezDecompressor(commands16.values())
+    if args.decompStyle == "sop":
+        with ProfilePhase("SopMinimization"):
+            return SopDecompressor(commands16.values())
+    return BuildSelectionTree()
+
+
 def GenerateVerilogDecompressor(outputPath):
-    selTree = SelectionTree.Generate(commands16.values())
-    with open(outputPath, "w") as f:
-        f.write("// Do not edit! This file is generated by gen_decompressor.py\n\n")
-        f.write(selTree.GenerateVerilog("insn16", "insn32"))
+    decompressor = BuildDecompressor()
+    s = "// Do not edit! This file is generated by gen_decompressor.py\n\n"
+    if isinstance(decompressor, SopDecompressor):
+        # Continuous assignments, no shared transforms
+        WriteOutput(outputPath, s + decompressor.GenerateVerilog("insn16", "insn32"))
+        return
+    sharing = None
+    if args.decompShare:
+        rootNode = decompressor.rootNode if isinstance(decompressor, SelectionTree) else None
+        sharing = TransformSharing(decompressor.commands, "insn16", rootNode)
+        s += sharing.GenerateDeclarations()
+    s += "always_comb begin\n"
+    if sharing is not None:
+        s += Indent(sharing.GenerateDefaults(), "    ")
+    s += Indent(decompressor.GenerateVerilog("insn16", "insn32", sharing), "    ")
+    s += "end\n"
+    WriteOutput(outputPath, s)
+
+
+class DecompressionTable:
+    """32-bits expansion of every possible 16-bits opcode, computed by walking the selection tree
+    and applying the selected command transform, exactly as the generated Verilog does.
+    Encodings which do not match the selected command (including 32-bits opcodes) are marked invalid
+    in the validity bitmap, their table entry is zero (never a valid expansion since two LSB of
+    32-bits opcode are always set).
+    """
+    SIZE = 1 << 16
+
+    def __init__(self, selTree) -> None:
+        # Expanded opcodes indexed by 16-bits opcode
+        self.insn32 = array("I", bytes(4 * DecompressionTable.SIZE))
+        if self.insn32.itemsize != 4:
+            self.insn32 = array("L", bytes(4 * DecompressionTable.SIZE))
+        # Validity bitmap, bit (opcode16 & 7) of byte (opcode16 >> 3) is set for valid entries
+        self.valid = bytearray(DecompressionTable.SIZE // 8)
+        # Commands in selection tree leaves order
+        self.commands = selTree.commands
+        # Index in `commands` for each opcode, -1 for invalid entries
+        self.cmdIndices = array("h", [-1]) * DecompressionTable.SIZE
+
+        cmdIndices = {cmd: idx for idx, cmd in enumerate(self.commands)}
+        for opcode16 in range(DecompressionTable.SIZE):
+            node = selTree.Classify(opcode16)
+            if node is None:
+                continue
+            self.insn32[opcode16] = GetCommandTransform(node).ApplyInt(opcode16)
+            self.valid[opcode16 >> 3] |= 1 << (opcode16 & 7)
+            self.cmdIndices[opcode16] = cmdIndices[node]
+
+    def IsValid(self, opcode16):
+        return self.valid[opcode16 >> 3] & (1 << (opcode16 & 7)) != 0
+
+    def Decompress(self, opcode16):
+        """
+        :param opcode16: 16-bits opcode (integer).
+        :return: 32-bits opcode (integer), None if the encoding is not supported.
+        """
+        if not self.IsValid(opcode16):
+            return None
+        return self.insn32[opcode16]
+
+    def GetCommand(self, opcode16):
+        """
+        :param opcode16: 16-bits opcode (integer).
+        :return: Command description, None if the encoding is not supported.
+        """
+        idx = self.cmdIndices[opcode16]
+        return None if idx < 0 else self.commands[idx]
+
+    def AsNumpy(self):
+        """
+        :return: Tuple (uint32 array of expanded opcodes, bool array of validity flags).
+        """
+        if np is None:
+            raise Exception("NumPy is required for the table export")
+        insn32 = np.frombuffer(self.insn32, dtype=np.uint32).copy()
+        valid = np.unpackbits(np.frombuffer(self.valid, dtype=np.uint8), bitorder="little")
+        return insn32, valid.astype(bool)
+
+    def Save(self, outputPath):
+        """Save the table. `.npy` extension produces NumPy arrays: the table in the specified file
+        and the packed validity bitmap in `<name>_valid.npy`. Otherwise raw binary is written: the
+        table as little-endian uint32 values followed by the validity bitmap.
+        """
+        if outputPath.endswith(".npy"):
+            if np is None:
+                raise Exception("NumPy is required for .npy output")
+            def NpyBytes(a):
+                f = io.BytesIO()
+                np.save(f, a)
+                return f.getvalue()
+            WriteOutput(outputPath,
+                        NpyBytes(np.frombuffer(self.insn32, dtype=np.uint32).astype("<u4")))
+            WriteOutput(outputPath[:-4] + "_valid.npy",
+                        NpyBytes(np.frombuffer(self.valid, dtype=np.uint8)))
+            return
+        insn32 = array(self.insn32.typecode, self.insn32)
+        if sys.byteorder != "little":
+            insn32.byteswap()
+        WriteOutput(outputPath, insn32.tobytes() + bytes(self.valid))
+
+
+def _ExpandByFieldsMany(cmd, opcodes16):
+    """Decompress opcodes by decoding the source command fields and encoding the target command with
+    them. This does not use CommandTransform, so it is used as a reference for verifying it.
+    :param cmd: 16-bits command description.
+    :param opcodes16: NumPy int64 array of the command opcodes.
+    :return: NumPy int64 array of 32-bits opcodes.
+    """
+    immValue = np.zeros(opcodes16.shape, dtype=np.int64)
+    for c, loPos, mask in cmd.encodeFields:
+        if isinstance(c, ImmediateBits):
+            immValue |= ((opcodes16 >> loPos) & mask) << c.loBit
+    if cmd.immIsSigned:
+        immValue -= ((immValue >> cmd.immHiBit) & 1) << (cmd.immHiBit + 1)
+
+    targetCmd = cmd.mapTo.targetCmd
+    result = np.full(opcodes16.shape, targetCmd.constantValue, dtype=np.int64)
+    for c, loPos, mask in targetCmd.encodeFields:
+        binding = cmd.mapTo.FindBinding(c)
+        if isinstance(c, RegReference):
+            if binding is not None:
+                value = binding
+            else:
+                srcReg = cmd.FindParam(c)
+                srcLoPos = srcReg.position - srcReg.GetSize() + 1
+                value = (opcodes16 >> srcLoPos) & ((1 << srcReg.GetSize()) - 1)
+                if srcReg.isCompressed:
+                    value = value + 8
+        else:
+            value = immValue if binding is None else binding
+            value = value >> c.loBit
+        result |= (value & mask) << loPos
+    return result
+
+
+def _MatchDirectMany(commands, opcodes):
+    """Classify opcodes by direct matching against every command description.
+    :param commands: List of 16-bits command descriptions.
+    :param opcodes: NumPy int64 array of 16-bits opcodes.
+    :return: NumPy int32 array of indices in `commands`, -1 for unsupported encodings.
+    """
+    result = np.full(opcodes.shape, -1, dtype=np.int32)
+    for cmdIdx, cmd in enumerate(commands):
+        matched = (opcodes & cmd.constantMask) == cmd.constantValue
+        for c in cmd.GetConstrainedRegisterFields():
+            loPos = c.position - c.GetSize() + 1
+            matched &= ((opcodes >> loPos) & ((1 << c.GetSize()) - 1)) != c.isNotEqual
+        overlapped = matched & (result != -1)
+        if overlapped.any():
+            opc = int(opcodes[overlapped][0])
+            raise Exception(f"Ambiguous encoding {opc:04x}: {commands[result[opc]]} and {cmd}")
+        result[matched] = cmdIdx
+    return result
+
+
+def VerifySelectionTreeExhaustive(selTree):
+    """Classify all 16-bits opcodes by walking the selection tree and by direct matching against
+    every command description, and check that both agree for all supported encodings. Then check
+    that CommandTransform of each command produces the same result as direct fields re-encoding.
+    """
+    if np is None:
+        raise Exception("NumPy is required for exhaustive verification")
+    commands = list(commands16.values())
+    opcodes = np.arange(DecompressionTable.SIZE, dtype=np.int64)
+    direct = _MatchDirectMany(commands, opcodes)
+
+    # Tree walk, translated to indices in `commands` (-1 index maps to the trailing -1)
+    treeCmdIndices = np.array([commands.index(cmd) for cmd in selTree.commands] + [-1],
+                              dtype=np.int32)
+    tree = treeCmdIndices[selTree.ClassifyMany(opcodes)]
+
+    supported = direct != -1
+    mismatched = tree != direct
+    if mismatched.any():
+        opc = int(opcodes[mismatched][0])
+        treeCmd = "nothing" if tree[opc] == -1 else commands[tree[opc]]
+        directCmd = "nothing" if direct[opc] == -1 else commands[direct[opc]]
+        raise Exception(f"Selection tree mismatch for {mismatched.sum()} opcodes, " +
+                        f"e.g. {opc:04x}: {treeCmd} selected instead of {directCmd}")
+
+    for cmdIdx, cmd in enumerate(commands):
+        cmdOpcodes = opcodes[direct == cmdIdx]
+        actual = GetCommandTransform(cmd).ApplyMany(cmdOpcodes)
+        expected = _ExpandByFieldsMany(cmd, cmdOpcodes)
+        mismatched = actual != expected
+        if mismatched.any():
+            idx = np.argmax(mismatched)
+            raise Exception(f"Bad transform for {cmd} opcode {int(cmdOpcodes[idx]):04x}: " +
+                            f"{int(actual[idx]):08x} != {int(expected[idx]):08x}")
+
+    print(f"Exhaustive verification passed: {supported.sum()} supported encodings, " +
+          f"{(~supported).sum()} unsupported")
+
+
+def VerifySopExhaustive(decompressor):
+    """Check that the minimized functions produce the same result as the decompression table for
+    all supported 16-bits opcodes.
+    """
+    if np is None:
+        raise Exception("NumPy is required for exhaustive verification")
+    expected, valid = DecompressionTable(BuildSelectionTree()).AsNumpy()
+    opcodes = np.arange(DecompressionTable.SIZE, dtype=np.int64)
+    actual = np.full(opcodes.shape, 3, dtype=np.int64)
+    for bit, terms in decompressor.outputs.items():
+        isSet = np.zeros(opcodes.shape, dtype=bool)
+        for mask, value in terms:
+            isSet |= (opcodes ^ value) & mask == 0
+        actual |= isSet.astype(np.int64) << bit
+    mismatched = valid & (actual != expected.astype(np.int64))
+    if mismatched.any():
+        opc = int(np.argmax(mismatched))
+        raise Exception(f"Minimized functions mismatch for {mismatched.sum()} opcodes, e.g. " +
+                        f"{opc:04x}: {int(actual[opc]):08x} != {int(expected[opc]):08x}")
+    numTerms = sum(len(terms) for terms in decompressor.outputs.values())
+    print(f"Minimized functions verification passed: {numTerms} product terms")
+
+
+DECOMPRESSOR_TESTBENCH_TEMPLATE = """\
+// Do not edit! This file is generated by gen_decompressor.py
+
+// Exhaustive RiscvInsnDecompressor test. All 16 bits input values are applied, and the output is
+// compared with expected values ROM. Unsupported encodings are not checked. Runs standalone, e.g.
+// verilator --binary --timing -I<fpga_core/src> --top-module RiscvInsnDecompressorTest <this file>
+// The ROM file is generated next to this file. Its path is relative to the simulator working
+// directory, and may be specified by +expectedPath=<path> plusarg.
+
+`include "riscv_core.sv"
+
+module RiscvInsnDecompressorTest;
+
+    parameter EXPECTED_PATH = "{expectedPath}";
+
+    string expectedPath;
+    // {{supported, insn32[31:2]}} for each insn16 value
+    reg [30:0] expected[0:65535];
+    reg [15:0] insn16;
+    wire [31:2] insn32;
+    integer i, numChecked, numErrors;
+
+    RiscvInsnDecompressor dut(.insn16(insn16), .insn32(insn32));
+
+    initial begin
+        if (!$value$plusargs("expectedPath=%s", expectedPath)) begin
+            expectedPath = EXPECTED_PATH;
+        end
+        $readmemh(expectedPath, expected);
+        numChecked = 0;
+        numErrors = 0;
+        for (i = 0; i < 65536; i = i + 1) begin
+            insn16 = i[15:0];
+            #1;
+            if (expected[i][30]) begin
+                numChecked = numChecked + 1;
+                if (insn32 !== expected[i][29:0]) begin
+                    if (numErrors < {maxReportedErrors}) begin
+                        $display("Mismatch for %h: %h, expected %h", insn16, {{insn32, 2'b11}},
+                                 {{expected[i][29:0], 2'b11}});
+                    end
+                    numErrors = numErrors + 1;
+                end
+            end
+        end
+        if (numErrors != 0) begin
+            $fatal(1, "%0d of %0d supported encodings mismatched", numErrors, numChecked);
+        end
+        $display("Exhaustive decompressor test passed: %0d supported encodings", numChecked);
+        $finish;
+    end
+
+endmodule
+"""
+
+
+def GenerateDecompressorTestbench(outputPath):
+    """Generate standalone exhaustive testbench for RiscvInsnDecompressor module, and expected
+    values ROM for it, placed next to the testbench. Expected values are computed by fields
+    re-encoding, independently of the selection tree and CommandTransform.
+    """
+    if np is None:
+        raise Exception("NumPy is required for testbench generation")
+    commands = list(commands16.values())
+    opcodes = np.arange(DecompressionTable.SIZE, dtype=np.int64)
+    direct = _MatchDirectMany(commands, opcodes)
+    # Bit 30 indicates supported encoding, insn32[31:2] in the rest bits
+    expected = np.zeros(opcodes.shape, dtype=np.int64)
+    for cmdIdx, cmd in enumerate(commands):
+        matched = direct == cmdIdx
+        expected[matched] = (_ExpandByFieldsMany(cmd, opcodes[matched]) >> 2) | (1 << 30)
+
+    expectedPath = os.path.splitext(outputPath)[0] + "_expected.hex"
+    WriteOutput(expectedPath, "".join(f"{v:08x}\n" for v in expected.tolist()))
+    WriteOutput(outputPath, DECOMPRESSOR_TESTBENCH_TEMPLATE.format(
+        expectedPath=os.path.basename(expectedPath), maxReportedErrors=16))
+
+
+def GenerateDecompressionTable(outputPath):
+    table = DecompressionTable(BuildSelectionTree())
+    table.Save(outputPath)
+
+
+ELF_MACHINE_RISCV = 243
+
+
+def FindElfSection(data, sectionName):
+    """Find section in 32-bits little-endian RISC-V ELF file.
+    :param data: ELF file content (bytes-like, e.g. mmap).
+    :return: Tuple (file offset, size) of the section.
+    """
+    if data[:4] != b"\x7fELF":
+        raise Exception("Not an ELF file")
+    if data[4] != 1 or data[5] != 1:
+        raise Exception("Only 32-bits little-endian ELF files are supported")
+    machine, = struct.unpack_from("<H", data, 0x12)
+    if machine != ELF_MACHINE_RISCV:
+        raise Exception(f"Not a RISC-V ELF file, machine {machine}")
+    shOffset, = struct.unpack_from("<I", data, 0x20)
+    shEntSize, shNum, shStrIdx = struct.unpack_from("<HHH", data, 0x2e)
+
+    def GetSection(idx):
+        # Tuple (name offset, file offset, size)
+        name, _, _, _, offset, size = struct.unpack_from("<IIIIII", data, shOffset + idx * shEntSize)
+        return name, offset, size
+
+    _, strTabOffset, _ = GetSection(shStrIdx)
+    for idx in range(shNum):
+        nameOffset, offset, size = GetSection(idx)
+        nameEnd = data.find(b"\0", strTabOffset + nameOffset)
+        if data[strTabOffset + nameOffset:nameEnd].decode("utf-8") == sectionName:
+            return offset, size
+    raise Exception(f"Section not found: {sectionName}")
+
+
+class ImageStats:
+    """Program image statistics collected by ImageDecompressor.
+    """
+    def __init__(self) -> None:
+        self.numInsn16 = 0
+        self.numInsn32 = 0
+        # Compressed encodings not supported by the decompressor
+        self.numUnsupported = 0
+        # Command name to number of occurrences
+        self.cmdCounts = {}
+
+    def GetImageSize(self):
+        return (self.numInsn16 + self.numUnsupported) * 2 + self.numInsn32 * 4
+
+    def GetExpandedSize(self):
+        return (self.numInsn16 + self.numUnsupported + self.numInsn32) * 4
+
+    def GetCompressionRatio(self):
+        """
+        :return: Image size relatively to the same program without compressed instructions.
+        """
+        expandedSize = self.GetExpandedSize()
+        return 1 if expandedSize == 0 else self.GetImageSize() / expandedSize
+
+    def ToJson(self):
+        return {
+            "numInsn16": self.numInsn16,
+            "numInsn32": self.numInsn32,
+            "numUnsupported": self.numUnsupported,
+            "imageSize": self.GetImageSize(),
+            "expandedSize": self.GetExpandedSize(),
+            "compressionRatio": self.GetCompressionRatio(),
+            "commands": dict(sorted(self.cmdCounts.items(), key=lambda item: -item[1]))
+        }
+
+    def GetSummary(self):
+        s = (f"Instructions: {self.numInsn16} compressed, {self.numInsn32} full size, " +
+             f"{self.numUnsupported} unsupported compressed\n" +
+             f"Size: {self.GetImageSize()} bytes, {self.GetExpandedSize()} bytes expanded, " +
+             f"compression ratio {self.GetCompressionRatio():.3f}")
+        for name, count in sorted(self.cmdCounts.items(), key=lambda item: -item[1]):
+            s += f"\n    {name:<12} {count}"
+        return s
+
+
+class ImageDecompressor:
+    """Expands RV32EC program image into a stream of 32-bits instructions. The image is walked as
+    mixed 16/32-bits instructions, compressed ones are expanded by the decompression table, so the
+    result is exactly what the generated decompressor produces. Unsupported compressed encodings are
+    expanded to zero (illegal instruction). Memory usage does not depend on the image size.
+    """
+    # Number of instructions in one output chunk
+    CHUNK_SIZE = 4096
+
+    def __init__(self, selTree) -> None:
+        self.table = DecompressionTable(selTree)
+        self.stats = ImageStats()
+
+    def Decompress(self, data, offset=0, size=None):
+        """Expand instructions and update statistics.
+        :param data: Image data (bytes-like, e.g. mmap).
+        :param offset: Offset of the code in the data.
+        :param size: Size of the code, till the data end if None.
+        :return: Iterator over chunks of little-endian 32-bits instructions (bytes).
+        """
+        if size is None:
+            size = len(data) - offset
+        if size % 2 != 0:
+            raise Exception(f"Code size is not multiple of 2 bytes: {size}")
+        table = self.table
+        stats = self.stats
+        cmdCounts = [0] * len(table.commands)
+        try:
+            chunk = array("I") if array("I").itemsize == 4 else array("L")
+            pos = offset
+            endPos = offset + size
+            while pos < endPos:
+                insn, = struct.unpack_from("<H", data, pos)
+                if insn & 3 == 3:
+                    if pos + 4 > endPos:
+                        raise Exception(f"Truncated 32-bits instruction at offset {pos - offset:x}")
+                    insn |= struct.unpack_from("<H", data, pos + 2)[0] << 16
+                    stats.numInsn32 += 1
+                    pos += 4
+                else:
+                    cmdIdx = table.cmdIndices[insn]
+                    if cmdIdx < 0:
+                        stats.numUnsupported += 1
+                    else:
+                        cmdCounts[cmdIdx] += 1
+                        stats.numInsn16 += 1
+                    insn = table.insn32[insn]
+                    pos += 2
+                chunk.append(insn)
+                if len(chunk) == ImageDecompressor.CHUNK_SIZE:
+                    yield ImageDecompressor._ChunkBytes(chunk)
+                    del chunk[:]
+            if len(chunk) > 0:
+                yield ImageDecompressor._ChunkBytes(chunk)
+        finally:
+            for cmd, count in zip(table.commands, cmdCounts):
+                if count > 0:
+                    stats.cmdCounts[cmd.name] = stats.cmdCounts.get(cmd.name, 0) + count
+
+    def DecompressFile(self, path, sectionName=".text"):
+        """Expand instructions of ELF file section or raw binary file. The file is memory-mapped.
+        :param sectionName: Section to expand if the file is ELF.
+        :return: Iterator over chunks of little-endian 32-bits instructions (bytes).
+        """
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:4] == b"\x7fELF":
+                offset, size = FindElfSection(data, sectionName)
+            else:
+                offset, size = 0, len(data)
+            yield from self.Decompress(data, offset, size)
+
+    @staticmethod
+    def _ChunkBytes(chunk):
+        if sys.byteorder != "little":
+            chunk = array(chunk.typecode, chunk)
+            chunk.byteswap()
+        return chunk.tobytes()
+
+
+def GenerateRegisteredVerilogDecompressor(outputPath):
+    WriteOutput(outputPath, "// Do not edit! This file is generated by gen_decompressor.py\n\n" +
+                GenerateRegisteredDecompressorVerilog(BuildDecompressor(), args.decompShare))
+
+
+def DecompressImage(imagePath, outputPath, statsOutputPath):
+    decompressor = ImageDecompressor(BuildSelectionTree())
+    chunks = decompressor.DecompressFile(imagePath, args.imageSection)
+    if outputPath is not None:
+        WriteOutput(outputPath, chunks)
+    else:
+        for _ in chunks:
+            pass
+    print(decompressor.stats.GetSummary())
+    if statsOutputPath is not None:
+        WriteOutput(statsOutputPath, json.dumps(decompressor.stats.ToJson(), indent=4))
+
+
+def CollectCommandsUsage(imagePaths):
+    """Count compressed commands used by the program images. Full commands table is used regardless
+    of any selection tree configuration.
+    :return: ImageStats accumulated over all the images.
+    """
+    decompressor = ImageDecompressor(SelectionTree.Generate(list(commands16.values())))
+    for imagePath in imagePaths:
+        for _ in decompressor.DecompressFile(imagePath, args.imageSection):
+            pass
+    return decompressor.stats
+
+
+def PruneUnusedCommands16(imagePaths):
+    """Remove compressed commands which are not used by any of the program images, so that the
+    decompressor and tests are generated for the used subset only.
+    """
+    stats = CollectCommandsUsage(imagePaths)
+    if stats.numUnsupported > 0:
+        print(f"Warning: {stats.numUnsupported} compressed instructions in the usage profile are " +
+              "not supported by the decompressor")
+    pruned = [name for name in commands16.keys() if name not in stats.cmdCounts]
+    for name in pruned:
+        del commands16[name]
+    print(f"Compressed commands used by the profile: {len(commands16)}, pruned: " +
+          (", ".join(pruned) if len(pruned) > 0 else "none"))
+
+
+def CheckImages(imagePaths, allowedCommands):
+    """Check that the program images use only the allowed compressed commands and no unsupported
+    compressed encodings.
+    :param allowedCommands: List of allowed command names, None to allow all the defined commands.
+    """
+    if allowedCommands is not None:
+        for name in allowedCommands:
+            if name not in commands16:
+                raise Exception(f"Unknown compressed command: {name}")
+    for imagePath in imagePaths:
+        stats = CollectCommandsUsage([imagePath])
+        errors = [f"{name} ({count})" for name, count in stats.cmdCounts.items()
+                  if allowedCommands is not None and name not in allowedCommands]
+        if stats.numUnsupported > 0:
+            errors.append(f"unsupported encodings ({stats.numUnsupported})")
+        if len(errors) > 0:
+            raise Exception(f"{imagePath} uses compressed commands not supported by the " +
+                            f"decompressor: {', '.join(errors)}")
+        print(f"{imagePath}: compressed commands usage is supported by the decompressor")
+
+
+USAGE_CHECK_TEMPLATE = """\
+# Do not edit! This file is generated by gen_decompressor.py
+
+# Compressed commands supported by the decompressor: {commands}
+set(RISCV_MARCH {march})
+
+find_package(Python3 REQUIRED COMPONENTS Interpreter)
+# Generator script location relative to this file
+set(RVC_USAGE_CHECK_SCRIPT "${{CMAKE_CURRENT_LIST_DIR}}/{scriptPath}")
+
+# Fail the target build if it uses compressed commands not supported by the decompressor
+function(check_rvc_usage target)
+    add_custom_command(TARGET ${{target}} POST_BUILD
+        COMMAND ${{Python3_EXECUTABLE}} "${{RVC_USAGE_CHECK_SCRIPT}}"
+                --checkImage "$<TARGET_FILE:${{target}}>" --allowedCommands {commands}
+        VERBATIM)
+endfunction()
+"""
+
+
+def GenerateUsageCheck(outputPath):
+    """Generate CMake script for application build which selects `-march` value (compressed
+    instructions are disabled if none is supported by the decompressor), and provides post-build
+    check for unsupported compressed commands. The generator script is referenced relatively to
+    the output, so the generated file does not depend on the source tree location.
+    """
+    scriptPath = os.path.relpath(os.path.abspath(__file__),
+                                 os.path.dirname(os.path.abspath(outputPath)))
+    WriteOutput(outputPath, USAGE_CHECK_TEMPLATE.format(
+        commands=" ".join(commands16.keys()), march="rv32ec" if len(commands16) > 0 else "rv32e",
+        scriptPath=scriptPath.replace(os.sep, "/")))
+
+
+def GenerateTestData():
+    """Iterate over all test cases, fixed and random ones. Repeated random cases are skipped.
+    :return: Iterator over tuples (command index in commands16, command, bindings, base command,
+    base bindings).
+    """
+    for cmdIdx, cmd in enumerate(commands16.values()):
+        tcs = itertools.chain(cmd.GenerateTestCases(),
+                              cmd.GenerateRandomTestCases(args.randomTests, args.randomSeed))
+        seenOpcodes = set()
+        for tc in tcs:
+            opc16 = cmd.GenerateOpcodeInt(tc)
+            if opc16 in seenOpcodes:
+                continue
+            seenOpcodes.add(opc16)
+            baseBindings = Bindings()
+            baseBindings.Extend(tc)
+            baseBindings.Extend(cmd.mapTo.bindings)
+            yield cmdIdx, cmd, tc, cmd.mapTo.targetCmd, baseBindings
+
+
+def GenerateTestCppCases():
+    """
+    :return: Iterator over TEST_CASE texts for all test cases.
+    """
+    for _, cmd, tc, baseCmd, baseBindings in GenerateTestData():
+        opc16 = cmd.GenerateOpcode(tc)
+        opc32 = baseCmd.GenerateOpcode(baseBindings)
+        yield (f"TEST_CASE(\"{cmd.GenerateAsm(tc)} => {baseCmd.GenerateAsm(baseBindings)}\",\n"
+               f"          ({', '.join(map(hex, opc16))}), ({', '.join(map(hex, opc32))}))\n\n")
+
+
+def GetTestCppShardPaths(outputPath, shardIdx):
+    """
+    :return: Tuple (test cases file path, translation unit path) for the specified shard.
+    """
+    stem = os.path.splitext(outputPath)[0]
+    return f"{stem}_{shardIdx}.inc", f"{stem}_{shardIdx}.cpp"
+
+
+TEST_VECTORS_MAGIC = b"RVCV"
+TEST_VECTORS_VERSION = 1
+
+
+def GenerateTestVectors(outputPath):
+    """Write test cases as packed binary test vectors. All values are little-endian.
+    Header: magic "RVCV", u32 version, u32 number of names, u32 names table size in bytes.
+    Names table: NUL-terminated compressed command names, padded with NUL to 4 bytes boundary.
+    Records till the end of file: u32 insn32, u16 insn16, u16 command index in names table.
+    """
+    names = b"".join(cmd.name.encode("utf-8") + b"\0" for cmd in commands16.values())
+    names += b"\0" * (-len(names) % 4)
+    header = (TEST_VECTORS_MAGIC + TEST_VECTORS_VERSION.to_bytes(4, "little") +
+              len(commands16).to_bytes(4, "little") + len(names).to_bytes(4, "little"))
+
+    def Records():
+        for cmdIdx, cmd, tc, baseCmd, baseBindings in GenerateTestData():
+            yield (baseCmd.GenerateOpcodeInt(baseBindings).to_bytes(4, "little") +
+                   cmd.GenerateOpcodeInt(tc).to_bytes(2, "little") +
+                   cmdIdx.to_bytes(2, "little"))
+
+    WriteOutput(outputPath, itertools.chain((header, names), Records()))
 
 
 def GenerateTestCpp(outputPath):
-     with open(outputPath, "w") as f:
-        f.write("// Do not edit! This file is generated by gen_decompressor.py\n\n")
-
-        for cmdName in commands16.keys():
-            cmd = commands16[cmdName]
-            tcs = cmd.GenerateTestCases()
-            for tc in tcs:
-                opc16 = cmd.GenerateOpcode(tc)
-                baseCmd = cmd.mapTo.targetCmd
-                baseBindings = Bindings()
-                baseBindings.Extend(tc)
-                baseBindings.Extend(cmd.mapTo.bindings)
-                opc32 = baseCmd.GenerateOpcode(baseBindings)
-                f.write(f"TEST_CASE(\"{cmd.GenerateAsm(tc)} => {baseCmd.GenerateAsm(baseBindings)}\",\n")
-                f.write(f"          ({', '.join(map(hex, opc16))}), ({', '.join(map(hex, opc32))}))\n\n")
+    header = "// Do not edit! This file is generated by gen_decompressor.py\n\n"
+    numShards = args.testShards or 0
+
+    # Shards left from previous run with bigger number of shards would register duplicated tests
+    stemPath = os.path.splitext(os.path.abspath(outputPath))[0]
+    shardPat = re.compile(re.escape(os.path.basename(stemPath)) + r"_(\d+)\.(inc|cpp)")
+    for fileName in os.listdir(os.path.dirname(stemPath)):
+        m = shardPat.fullmatch(fileName)
+        if m is not None and int(m.group(1)) >= numShards:
+            os.remove(os.path.join(os.path.dirname(stemPath), fileName))
+
+    if numShards == 0:
+        WriteOutput(outputPath, itertools.chain((header,), GenerateTestCppCases()))
+        return
+
+    # Test cases are generated twice (counting pass first) to split them evenly without keeping
+    # all of them in memory.
+    numCases = sum(1 for _ in GenerateTestCppCases())
+    cases = GenerateTestCppCases()
+    WriteOutput(outputPath, header + f"// Test cases are sharded into {numShards} files\n")
+    for shardIdx in range(numShards):
+        incPath, cppPath = GetTestCppShardPaths(outputPath, shardIdx)
+        shardSize = (shardIdx + 1) * numCases // numShards - shardIdx * numCases // numShards
+        WriteOutput(incPath, itertools.chain((header,), itertools.islice(cases, shardSize)))
+        WriteOutput(cppPath, header + "#include <riscv_decompressor_test.h>\n\n" +
+                    f"#include \"{os.path.basename(incPath)}\"\n")
+
+
+# Output path to content hash for files produced in this run
+writtenOutputs = {}
+
+
+def GetFileHash(path):
+    """
+    :return: SHA-256 of the file content, None if the file cannot be read.
+    """
+    h = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+    except OSError:
+        return None
+    return h.hexdigest()
 
 
-def Main():
-    global args
+def WriteOutput(outputPath, content):
+    """Write output file. The file is not touched if it already has the same content, so that its
+    timestamp is preserved and dependent build steps are not triggered.
+    :param content: str, bytes or iterable of str chunks. Chunks are streamed through a temporary
+    file, so big outputs are never kept in memory entirely.
+    """
+    if isinstance(content, (str, bytes)):
+        content = (content,)
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outputPath)),
+                                   prefix=".gen_decompressor_")
+    try:
+        h = hashlib.sha256()
+        with os.fdopen(fd, "wb") as f:
+            for chunk in content:
+                data = chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+                h.update(data)
+                f.write(data)
+        writtenOutputs[outputPath] = h.hexdigest()
+        if GetFileHash(outputPath) != writtenOutputs[outputPath]:
+            SetReplacementMode(tmpPath, outputPath)
+            os.replace(tmpPath, outputPath)
+    finally:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+
+# Options which do not affect outputs
+FINGERPRINT_IGNORED_OPTIONS = {"stampFile", "jobs", "noAsmCache", "asmCachePath", "asmCacheSize",
+                               "noAsmBatch", "profile", "profileOut", "profileStats"}
+
+
+def ComputeFingerprint():
+    """
+    :return: Hash of everything the outputs depend on: generator source, commands tables, options
+    and toolchain identity.
+    """
+    h = hashlib.sha256()
+    with open(__file__, "rb") as f:
+        h.update(f.read())
+
+    for commands in (commands32, commands16):
+        for cmd in commands.values():
+            desc = cmd.name
+            for c in cmd.components:
+                desc += f" {c}"
+                if isinstance(c, RegReference) and c.isNotEqual is not None:
+                    desc += f"!={c.isNotEqual}"
+            if cmd.mapTo is not None:
+                desc += f" -> {cmd.mapTo.targetCmd} {cmd.mapTo.bindings}"
+            desc += f" {cmd.isImmOffset}\n"
+            h.update(desc.encode("utf-8"))
+
+    options = {k: v for k, v in vars(args).items() if k not in FINGERPRINT_IGNORED_OPTIONS}
+    h.update(json.dumps(options, sort_keys=True).encode("utf-8"))
+    if args.treeWeights:
+        with open(args.treeWeights, "rb") as f:
+            h.update(f.read())
+    for imagePath in [args.decompressImage] + (args.usageProfile or []):
+        if imagePath is not None:
+            h.update(str(GetFileHash(imagePath)).encode("utf-8"))
+    if args.doSelfTest and args.compiler is not None and args.asmOracle != "builtin":
+        for tool in (args.compiler, args.objdump):
+            h.update(GetToolSignature(tool)[1].encode("utf-8"))
+    return h.hexdigest()
+
+
+def IsUpToDate(stampPath, fingerprint):
+    """
+    :return: True if the stamp file has the same fingerprint and all the outputs recorded in it
+    are present and unmodified.
+    """
+    try:
+        with open(stampPath, "r") as f:
+            stamp = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if stamp.get("fingerprint") != fingerprint:
+        return False
+    for outputPath, outputHash in stamp.get("outputs", {}).items():
+        if GetFileHash(outputPath) != outputHash:
+            return False
+    return True
+
+
+def SaveStamp(stampPath, fingerprint):
+    with open(stampPath, "w") as f:
+        json.dump({"fingerprint": fingerprint, "outputs": writtenOutputs}, f, indent=4)
 
+
+def CreateArgParser():
     parser = argparse.ArgumentParser(description="Generate opcodes decompressor and tests")
     parser.add_argument("--doSelfTest", action="store_true")
     parser.add_argument("--compiler", metavar="COMPILER_PATH", type=str,
                         help="Compiler path for self-testing")
     parser.add_argument("--objdump", metavar="OBJDUMP_PATH", type=str,
                         help="objdump path for self-testing")
+    parser.add_argument("--asmOracle", choices=["toolchain", "builtin", "both"],
+                        help="Reference for self-testing: external toolchain, built-in encoder or " +
+                        "both with cross-checking. Default is toolchain if compiler is specified, " +
+                        "built-in encoder otherwise")
+    parser.add_argument("--noAsmBatch", action="store_true",
+                        help="Invoke toolchain for each command separately instead of assembling " +
+                        "all self-test commands in one translation unit")
+    parser.add_argument("--jobs", metavar="N", type=int, default=1,
+                        help="Number of parallel jobs for self-testing")
+    parser.add_argument("--no-asm-cache", dest="noAsmCache", action="store_true",
+                        help="Do not use persistent cache of assembled opcodes")
+    parser.add_argument("--asmCachePath", metavar="CACHE_PATH", type=str,
+                        help="Assembled opcodes cache file path, default is " +
+                        "$XDG_CACHE_HOME/gen_decompressor/asm_cache.json")
+    # Fits several full random self-test runs (--randomTests 300 stores over 20000 entries) besides
+    # the fixed self-test cases
+    parser.add_argument("--asmCacheSize", metavar="N", type=int, default=100000,
+                        help="Maximal number of entries in assembled opcodes cache")
     parser.add_argument("--decompOut", metavar="DECOMP_CODE_PATH", type=str,
                         help="Path to Verilog file with generated decompressor code")
     parser.add_argument("--testCppOut", metavar="TEST_CODE_PATH", type=str,
                         help="Path to C++ file with generated test data code")
+    parser.add_argument("--decompTableOut", metavar="TABLE_PATH", type=str,
+                        help="Path to decompression table of all 16-bits opcodes, NumPy format " +
+                        "for .npy extension, raw binary otherwise")
+    parser.add_argument("--decompStyle", choices=["tree", "casez", "sop"], default="tree",
+                        help="Decompressor implementation: nested if/else selection tree, flat " +
+                        "unique casez or minimized sum of products for each output bit")
+    parser.add_argument("--decompShare", action="store_true",
+                        help="Emit common transform fields as shared wires, and merge selection " +
+                        "subtrees whose commands differ only in a few constant bits")
+    parser.add_argument("--decompTree", choices=["greedy", "minDepth", "minCost"],
+                        default="greedy",
+                        help="Selection tree generation: greedy balancing, search for minimal " +
+                        "depth or for minimal weighted cost")
+    parser.add_argument("--treeSearchTime", metavar="SECONDS", type=float, default=30,
+                        help="Time budget for selection tree search")
+    parser.add_argument("--treeWeights", metavar="WEIGHTS_PATH", type=str,
+                        help="JSON file with commands weights for selection tree cost, " +
+                        "dictionary by compressed command name")
+    parser.add_argument("--costReport", action="store_true",
+                        help="Print structural cost estimation for the generated decompressor")
+    parser.add_argument("--costReportOut", metavar="REPORT_PATH", type=str,
+                        help="Path to JSON file with structural cost estimation for the " +
+                        "generated decompressor")
+    parser.add_argument("--exhaustiveCheck", action="store_true",
+                        help="Verify selection tree and transforms on all 16-bits opcodes " +
+                        "(requires NumPy)")
+    parser.add_argument("--randomTests", metavar="N", type=int, default=0,
+                        help="Number of random test cases per compressed command, in addition to " +
+                        "the fixed ones, for self-test and generated test data")
+    parser.add_argument("--randomSeed", metavar="SEED", type=int, default=0,
+                        help="Seed for random test cases generation")
+    parser.add_argument("--decompRegisteredOut", metavar="OUTPUT_PATH", type=str,
+                        help="Path for registered (one cycle latency) decompressor Verilog output")
+    parser.add_argument("--decompTestbenchOut", metavar="OUTPUT_PATH", type=str,
+                        help="Path for exhaustive decompressor testbench output (requires NumPy). " +
+                        "Expected values ROM is written next to it")
+    parser.add_argument("--testVectorsOut", metavar="OUTPUT_PATH", type=str,
+                        help="Path for packed binary test vectors output")
+    parser.add_argument("--testShards", metavar="N", type=int,
+                        help="Split test cases evenly into N files, each with its own translation " +
+                        "unit placed next to the test cases output, so that they can be compiled in " +
+                        "parallel")
+    parser.add_argument("--decompressImage", metavar="IMAGE_PATH", type=str,
+                        help="Expand RV32EC program image (ELF or raw binary) and print its " +
+                        "compression statistics")
+    parser.add_argument("--imageSection", metavar="SECTION_NAME", type=str, default=".text",
+                        help="ELF section to expand")
+    parser.add_argument("--imageOut", metavar="OUTPUT_PATH", type=str,
+                        help="Path for expanded image output, little-endian 32-bits instructions")
+    parser.add_argument("--imageStatsOut", metavar="OUTPUT_PATH", type=str,
+                        help="Path for image statistics JSON output")
+    parser.add_argument("--usageProfile", metavar="ELF_PATH", type=str, nargs="+",
+                        help="Generate decompressor and tests only for compressed commands used by " +
+                        "the specified application images")
+    parser.add_argument("--usageCheckOut", metavar="OUTPUT_PATH", type=str,
+                        help="Path for CMake script with -march selection and post-build check " +
+                        "for compressed commands supported by the decompressor")
+    parser.add_argument("--checkImage", metavar="ELF_PATH", type=str, nargs="+",
+                        help="Check that the images use only compressed commands supported by the " +
+                        "decompressor")
+    parser.add_argument("--allowedCommands", metavar="NAME", type=str, nargs="*",
+                        help="Compressed commands allowed for --checkImage, all defined commands " +
+                        "by default")
+    parser.add_argument("--profile", action="store_true",
+                        help="Print wall and CPU time of generation phases and external tools " +
+                        "invocations statistics")
+    parser.add_argument("--profileOut", metavar="OUTPUT_PATH", type=str,
+                        help="Path for profiling results JSON output, implies --profile")
+    parser.add_argument("--profileStats", metavar="OUTPUT_PATH", type=str,
+                        help="Path for cProfile statistics dump (readable by pstats module), " +
+                        "implies --profile")
+    parser.add_argument("--stampFile", metavar="STAMP_PATH", type=str,
+                        help="Enable incremental regeneration: inputs fingerprint is stored in this " +
+                        "file, and nothing is done if it matches and outputs are not modified")
+
+    return parser
+
+
+def Generate():
+    """Perform all the actions requested by command line arguments.
+    """
+    with ProfilePhase("DefineCommands"):
+        DefineCommands32()
+        DefineCommands16()
+
+    if args.checkImage:
+        with ProfilePhase("CheckImages"):
+            CheckImages(args.checkImage, args.allowedCommands)
+
+    fingerprint = None
+    if args.stampFile:
+        with ProfilePhase("Fingerprint"):
+            fingerprint = ComputeFingerprint()
+            isUpToDate = IsUpToDate(args.stampFile, fingerprint)
+        if isUpToDate:
+            print("Outputs are up to date")
+            return
 
-    args = parser.parse_args()
+    if args.usageProfile:
+        with ProfilePhase("PruneUnusedCommands16"):
+            PruneUnusedCommands16(args.usageProfile)
 
-    DefineCommands32()
-    DefineCommands16()
     if args.doSelfTest:
-        DoSelfTest()
+        with ProfilePhase("DoSelfTest"):
+            DoSelfTest()
+
+    if args.exhaustiveCheck:
+        with ProfilePhase("ExhaustiveCheck"):
+            VerifySelectionTreeExhaustive(BuildSelectionTree())
+            if args.decompStyle == "sop":
+                VerifySopExhaustive(BuildDecompressor())
 
     if args.decompOut:
-        GenerateVerilogDecompressor(args.decompOut)
+        with ProfilePhase("GenerateVerilogDecompressor"):
+            GenerateVerilogDecompressor(args.decompOut)
+
+    if args.decompRegisteredOut:
+        with ProfilePhase("GenerateRegisteredVerilogDecompressor"):
+            GenerateRegisteredVerilogDecompressor(args.decompRegisteredOut)
+
+    if args.costReport or args.costReportOut:
+        with ProfilePhase("GenerateCostReport"):
+            GenerateCostReport(BuildDecompressor(), args.costReportOut)
 
     if args.testCppOut:
-        GenerateTestCpp(args.testCppOut)
+        with ProfilePhase("GenerateTestCpp"):
+            GenerateTestCpp(args.testCppOut)
+
+    if args.decompTestbenchOut:
+        with ProfilePhase("GenerateDecompressorTestbench"):
+            GenerateDecompressorTestbench(args.decompTestbenchOut)
+
+    if args.testVectorsOut:
+        with ProfilePhase("GenerateTestVectors"):
+            GenerateTestVectors(args.testVectorsOut)
+
+    if args.decompTableOut:
+        with ProfilePhase("GenerateDecompressionTable"):
+            GenerateDecompressionTable(args.decompTableOut)
+
+    if args.usageCheckOut:
+        with ProfilePhase("GenerateUsageCheck"):
+            GenerateUsageCheck(args.usageCheckOut)
 
+    if args.decompressImage:
+        with ProfilePhase("DecompressImage"):
+            DecompressImage(args.decompressImage, args.imageOut, args.imageStatsOut)
+
+    if fingerprint is not None:
+        SaveStamp(args.stampFile, fingerprint)
+
+
+def Main():
+    global args, profiler
+
+    args = CreateArgParser().parse_args()
+
+    if not (args.profile or args.profileOut or args.profileStats):
+        Generate()
+        return
+
+    profiler = Profiler()
+    # Only the main thread is profiled by cProfile, self-test jobs are not visible there
+    cProfiler = cProfile.Profile() if args.profileStats else None
+    startWall = time.perf_counter()
+    startCpu = time.process_time()
+    try:
+        if cProfiler is not None:
+            cProfiler.enable()
+        Generate()
+    finally:
+        if cProfiler is not None:
+            cProfiler.disable()
+            cProfiler.dump_stats(args.profileStats)
+        profiler.phases["Total"] = [time.perf_counter() - startWall,
+                                    time.process_time() - startCpu]
+        print(profiler.GetSummary())
+        if args.profileOut:
+            with open(args.profileOut, "w") as f:
+                json.dump(profiler.ToJson(), f, indent=4)
 
 if __name__ == "__main__":
     Main()